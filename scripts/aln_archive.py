@@ -0,0 +1,143 @@
+import argparse
+import pathlib
+import struct
+import json
+import zlib
+import io
+
+# archive layout:
+#   MAGIC
+#   one zlib-compressed fasta record per alignment
+#   zlib-compressed json index {name: [offset, size]}
+#   footer: index offset and size (2 x uint64, little endian) + MAGIC
+MAGIC = b"ALNZ\x01\n"
+FOOTER = struct.Struct("<QQ")
+ARCHIVE_NAME = "alignments.alnz"
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="List or extract alignments from an alignment archive"
+    )
+    sub = parser.add_subparsers(dest="command", required=True)
+    ls = sub.add_parser("list", help="List the alignments in the archive")
+    ls.add_argument("--archive", type=str, required=True)
+    ext = sub.add_parser("extract", help="Extract alignments as fasta files")
+    ext.add_argument("--archive", type=str, required=True)
+    ext.add_argument("--out_fld", type=str, required=True)
+    ext.add_argument(
+        "--names", type=str, nargs="+", help="Alignments to extract (default: all)"
+    )
+    return parser.parse_args()
+
+
+def fasta_text(records):
+    """Fasta text of a list of Bio SeqRecords, identical to the content of
+    the file written by SeqIO.write."""
+    from Bio import SeqIO
+
+    buf = io.StringIO()
+    SeqIO.write(records, buf, "fasta")
+    return buf.getvalue()
+
+
+def compress(text):
+    return zlib.compress(text.encode(), 6)
+
+
+class ArchiveWriter:
+    """Write alignments one at a time, each compressed independently so that
+    they can be read back individually."""
+
+    def __init__(self, fname):
+        self.fname = pathlib.Path(fname)
+        self.tmp_fname = self.fname.with_name(self.fname.name + ".tmp")
+        self.f = open(self.tmp_fname, "wb")
+        self.f.write(MAGIC)
+        self.index = {}
+
+    def add_compressed(self, name, data):
+        if name in self.index:
+            raise ValueError(f"duplicated alignment {name} in archive")
+        self.index[name] = [self.f.tell(), len(data)]
+        self.f.write(data)
+
+    def add(self, name, records):
+        self.add_compressed(name, compress(fasta_text(records)))
+
+    def close(self):
+        idx = zlib.compress(json.dumps(self.index).encode())
+        offset = self.f.tell()
+        self.f.write(idx)
+        self.f.write(FOOTER.pack(offset, len(idx)) + MAGIC)
+        self.f.close()
+        self.tmp_fname.replace(self.fname)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.f.close()
+            self.tmp_fname.unlink()
+
+
+class ArchiveReader:
+    """Random access to the alignments of an archive by name."""
+
+    def __init__(self, fname):
+        self.f = open(fname, "rb")
+        if self.f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{fname} is not an alignment archive")
+        self.f.seek(-(FOOTER.size + len(MAGIC)), io.SEEK_END)
+        offset, size = FOOTER.unpack(self.f.read(FOOTER.size))
+        if self.f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{fname} is truncated")
+        self.f.seek(offset)
+        self.index = json.loads(zlib.decompress(self.f.read(size)))
+
+    def names(self):
+        return list(self.index)
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def fasta(self, name):
+        offset, size = self.index[name]
+        self.f.seek(offset)
+        return zlib.decompress(self.f.read(size)).decode()
+
+    def records(self, name):
+        from Bio import SeqIO
+
+        return list(SeqIO.parse(io.StringIO(self.fasta(name)), "fasta"))
+
+    def extract(self, name, out_fld):
+        out_fld = pathlib.Path(out_fld)
+        out_fld.mkdir(exist_ok=True, parents=True)
+        with open(out_fld / f"{name}.fa", "w") as f:
+            f.write(self.fasta(name))
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    with ArchiveReader(args.archive) as ar:
+        if args.command == "list":
+            for name in ar.names():
+                print(name)
+        elif args.command == "extract":
+            names = ar.names() if args.names is None else args.names
+            for name in names:
+                ar.extract(name, args.out_fld)
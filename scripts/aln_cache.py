@@ -0,0 +1,148 @@
+import graph_cache as gc
+import pathlib
+import argparse
+import json
+import zlib
+import os
+
+# default size cap of the cache, in bytes
+MAX_BYTES = 4 << 30
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Inspect or trim the shared cache of block alignments"
+    )
+    parser.add_argument("--cache", type=str, required=True, help="Cache folder")
+    parser.add_argument(
+        "--max_gb",
+        type=float,
+        help="Evict least recently used alignments down to this size",
+    )
+    parser.add_argument("--clear", action="store_true", help="Remove all entries")
+    return parser.parse_args()
+
+
+def block_digests(pan, graph_file=None):
+    """Alignment digest of every block. Taken from the graph itself when it
+    was loaded from the binary cache, otherwise from the cache file of
+    `graph_file`. The cache file is only read, never
+    built. Empty if no digests are available: alignments are then always
+    reconstructed."""
+    digests = pan.block_digests() if hasattr(pan, "block_digests") else {}
+    if digests or graph_file is None:
+        return digests
+    cache_file = gc.default_cache_file(graph_file)
+    if not os.path.exists(cache_file):
+        return {}
+    meta, arrays = gc.load_cache(cache_file)
+    if not gc.is_fresh(meta, graph_file):
+        return {}
+    return dict(zip(arrays["block_ids"].tolist(), arrays["block_digest"].tolist()))
+
+
+class AlignmentCache:
+    """Content-addressed on-disk cache of reconstructed block alignments.
+
+    Entries are keyed by block id and by the digest of the block alignment
+    data, so they are valid across stages, comparisons and reruns for as
+    long as the block does not change. Each entry is a zlib-compressed json
+    file with the gapped sequences and the occurrences, as returned by
+    `generate_alignments`. Recency is tracked with the file mtime and, when
+    the cache grows over `max_bytes`, least recently used entries are
+    evicted. Writes are atomic, so several processes can share a cache."""
+
+    def __init__(self, folder, max_bytes=MAX_BYTES):
+        self.folder = pathlib.Path(folder)
+        self.folder.mkdir(exist_ok=True, parents=True)
+        self.max_bytes = max_bytes
+        self.size = sum(st.st_size for _, st in self.entries())
+
+    def fname(self, bid, digest):
+        # spread entries over subfolders to keep directories small
+        return self.folder / digest[:2] / f"{bid}.{digest}.json.z"
+
+    def entries(self):
+        res = []
+        for f in self.folder.glob("*/*.json.z"):
+            try:
+                res.append((f, f.stat()))
+            except FileNotFoundError:
+                # evicted by another process
+                continue
+        return res
+
+    def get(self, bid, digest):
+        fname = self.fname(bid, digest)
+        try:
+            with open(fname, "rb") as f:
+                data = json.loads(zlib.decompress(f.read()))
+            os.utime(fname)
+        except (FileNotFoundError, zlib.error, ValueError):
+            return None
+        occs = [tuple(o) for o in data["occs"]]
+        return data["seqs"], occs
+
+    def put(self, bid, digest, seqs, occs):
+        fname = self.fname(bid, digest)
+        fname.parent.mkdir(exist_ok=True)
+        data = zlib.compress(json.dumps({"seqs": seqs, "occs": occs}).encode(), 6)
+        tmp_fname = fname.with_name(f"{fname.name}.{os.getpid()}.tmp")
+        with open(tmp_fname, "wb") as f:
+            f.write(data)
+        os.replace(tmp_fname, fname)
+        self.size += len(data)
+        if self.size > self.max_bytes:
+            self.evict(self.max_bytes)
+
+    def evict(self, max_bytes):
+        """Remove least recently used entries until the cache is below
+        `max_bytes`, leaving some headroom to avoid evicting on every put."""
+        target = 0.9 * max_bytes
+        entries = sorted(self.entries(), key=lambda x: x[1].st_mtime_ns)
+        self.size = sum(st.st_size for _, st in entries)
+        for f, st in entries:
+            if self.size <= target:
+                break
+            f.unlink(missing_ok=True)
+            self.size -= st.st_size
+
+    def alignments(self, bid, aln, digest):
+        """Gapped sequences and occurrences of the block alignment `aln`,
+        from the cache or reconstructed (and cached) if missing."""
+        res = None if digest is None else self.get(bid, digest)
+        if res is None:
+            seqs, occs = aln.generate_alignments()
+            seqs, occs = list(seqs), [tuple(o) for o in occs]
+            if digest is not None:
+                self.put(bid, digest, seqs, occs)
+            res = seqs, occs
+        return res
+
+
+def generate_alignments(bid, aln, digest=None, cache=None):
+    # same as `aln.generate_alignments()`, going through the alignment
+    # cache if one is given
+    if cache is None:
+        return aln.generate_alignments()
+    return cache.alignments(bid, aln, digest)
+
+
+def open_cache(folder, max_gb=None):
+    # helper for the command line options of the pipeline scripts
+    if folder is None:
+        return None
+    max_bytes = MAX_BYTES if max_gb is None else int(max_gb * (1 << 30))
+    return AlignmentCache(folder, max_bytes)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    cache = open_cache(args.cache, args.max_gb)
+    if args.clear:
+        cache.evict(0)
+    elif args.max_gb is not None:
+        cache.evict(cache.max_bytes)
+    n = len(cache.entries())
+    print(f"{n} alignments, {cache.size / (1 << 20):.1f} MB")
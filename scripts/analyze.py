@@ -0,0 +1,279 @@
+import pandas as pd
+import graph_cache as gc
+import table_io as tio
+import functools
+import pathlib
+import argparse
+
+# stage -> stages whose in-memory results it consumes
+STAGES = {
+    "block_stats": [],
+    "block_positions": [],
+    "core_alignments": [],
+    "mutations_positions": ["block_positions", "core_alignments"],
+    "msu": [],
+    "msu_alignments": ["msu"],
+    "dotplot": [],
+    "dotplot_png": [],
+    "dotplot_tiles": [],
+    "msu_dotplot": ["msu"],
+}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Run all per-comparison stages in a single process"
+    )
+    parser.add_argument("--graph", type=str, help="Pangraph JSON file", required=True)
+    parser.add_argument(
+        "--seq_lengths", type=str, help="Sequence lengths CSV file", required=True
+    )
+    parser.add_argument(
+        "--out_dir", type=str, help="Comparison results folder", required=True
+    )
+    parser.add_argument(
+        "--stages",
+        type=str,
+        nargs="+",
+        choices=list(STAGES),
+        default=list(STAGES),
+        help="Stages to run (default: all)",
+    )
+    parser.add_argument(
+        "--table_format",
+        type=str,
+        choices=list(tio.FORMATS),
+        default="csv",
+        help="Format of the mutation tables",
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=1,
+        help="Number of worker processes for the parallel stages",
+    )
+    parser.add_argument(
+        "--aln_archive",
+        action="store_true",
+        help="Save alignments in a single indexed archive per folder",
+    )
+    parser.add_argument(
+        "--aln_cache", type=str, help="Shared cache of reconstructed alignments"
+    )
+    parser.add_argument(
+        "--aln_cache_gb", type=float, help="Size cap of the alignment cache (GB)"
+    )
+    parser.add_argument(
+        "--dotplot_max_copies",
+        type=int,
+        help="Draw larger duplicated families as density cells in the dotplot",
+    )
+    return parser.parse_args()
+
+
+def resolve_stages(stages):
+    """Add the dependencies of the requested stages, in execution order."""
+    required = set()
+    todo = list(stages)
+    while todo:
+        s = todo.pop()
+        if s not in required:
+            required.add(s)
+            todo += STAGES[s]
+    return [s for s in STAGES if s in required]
+
+
+class Analysis:
+    """Shared state of a single comparison. The graph and the input tables
+    are loaded at most once, and the stage results are kept in memory for
+    the downstream stages."""
+
+    def __init__(
+        self,
+        graph,
+        seq_lengths,
+        out_dir,
+        stages,
+        table_format="csv",
+        threads=1,
+        aln_archive=False,
+        aln_cache=None,
+        aln_cache_gb=None,
+        dotplot_max_copies=None,
+    ):
+        self.graph_file = graph
+        self.table_format = table_format
+        self.threads = threads
+        self.aln_archive = aln_archive
+        self.aln_cache = aln_cache
+        self.aln_cache_gb = aln_cache_gb
+        self.dotplot_max_copies = dotplot_max_copies
+        self.seq_lengths_file = seq_lengths
+        self.out = pathlib.Path(out_dir)
+        self.stages = resolve_stages(stages)
+        self.results = {}
+
+    @functools.cached_property
+    def cache(self):
+        import aln_cache as ac
+
+        return ac.open_cache(self.aln_cache, self.aln_cache_gb)
+
+    @functools.cached_property
+    def pan(self):
+        # load alignment data only for the blocks that the stages need
+        stages = set(self.stages)
+        if "msu_alignments" in stages:
+            return gc.load_graph(self.graph_file, alignments=True)
+        if "core_alignments" in stages:
+            return gc.load_graph(self.graph_file, alignments=True, blocks="core")
+        return gc.load_graph(self.graph_file, blocks=())
+
+    @functools.cached_property
+    def Ls(self):
+        return pd.read_csv(self.seq_lengths_file).set_index("id")["length"].to_dict()
+
+    def run(self):
+        for stage in self.stages:
+            self.results[stage] = RUNNERS[stage](self)
+
+
+def run_block_stats(an):
+    import block_stats as bs
+
+    bdf = bs.block_stats_df(an.pan)
+    bdf.to_csv(an.out / "block_stats.csv")
+    return bdf
+
+
+def run_block_positions(an):
+    import block_positions as bp
+
+    df = bp.block_position_dataframe(an.pan)
+    df.to_csv(an.out / "block_positions.csv", index=False)
+    return df
+
+
+def run_core_alignments(an):
+    import core_blocks_alignments as cba
+    import aln_cache as ac
+
+    aln_fld = an.out / "core_alignments"
+    aln_fld.mkdir(exist_ok=True, parents=True)
+    # the streamed graph carries no digests: take them from the binary cache
+    digests = None if an.cache is None else ac.block_digests(an.pan, an.graph_file)
+    snps, ins, dels = cba.core_alignments(
+        an.pan, aln_fld, an.threads, an.aln_archive, an.cache, digests
+    )
+    cba.save_variations(snps, ins, dels, aln_fld, an.table_format)
+    return snps, ins, dels
+
+
+def run_mutations_positions(an):
+    import mutations_positions as mp
+
+    M, I, D = an.results["core_alignments"]
+    P = an.results["block_positions"].set_index(
+        ["genome", "block_id", "occurrence_number"]
+    )
+    df = mp.mutations_positions(an.pan, I, D, M, an.Ls, P)
+    ext = tio.FORMATS[an.table_format]
+    tio.write_table(df, an.out / f"mutations_positions{ext}", partition_by="block_id")
+    return df
+
+
+def run_msu(an):
+    import synteny_units as sy
+
+    df = sy.minimal_synteny_units(an.pan)
+    (an.out / "msu").mkdir(exist_ok=True, parents=True)
+    df.to_csv(an.out / "msu" / "minimal_synteny_units.csv", index=False)
+    return df
+
+
+def run_msu_alignments(an):
+    import msu_alignments as ma
+    import aln_cache as ac
+    import matplotlib.pyplot as plt
+
+    msu_dict, sign_dict, msu = ma.msu_tables(an.pan, an.results["msu"])
+    # the full graph carries no digests: take them from the binary cache
+    digests = None if an.cache is None else ac.block_digests(an.pan, an.graph_file)
+    fig, df = ma.msu_alignments(
+        an.pan,
+        an.Ls,
+        msu_dict,
+        sign_dict,
+        msu,
+        an.out / "msu" / "alignments",
+        an.aln_archive,
+        an.cache,
+        digests,
+    )
+    fig.savefig(an.out / "msu" / "mutations.pdf")
+    plt.close(fig)
+    df.to_csv(an.out / "msu" / "info.csv", index=False)
+    return df
+
+
+def run_dotplot(an):
+    import dotplot as dp
+
+    fig = dp.dotplot(an.pan, an.Ls, an.dotplot_max_copies)
+    fig.write_html(an.out / "dotplot.html")
+
+
+def run_dotplot_png(an):
+    import dotplot as dp
+
+    dp.write_png(dp.raster_dotplot(an.pan, an.Ls), an.out / "dotplot.png")
+
+
+def run_dotplot_tiles(an):
+    import dotplot_tiles as dt
+
+    pyr, names = dt.pyramid(an.pan, an.Ls)
+    dt.write_tiles(pyr, names, an.out / "dotplot_tiles")
+
+
+def run_msu_dotplot(an):
+    import msu_dotplot as md
+    import matplotlib.pyplot as plt
+
+    msu_dict, sign_dict = md.msu_dicts(an.results["msu"])
+    block_pos = md.block_positions(an.pan)
+    fig, axs = md.create_figure(an.pan, an.Ls, msu_dict, sign_dict, block_pos)
+    fig.savefig(an.out / "msu" / "dotplot.pdf")
+    plt.close(fig)
+
+
+RUNNERS = {
+    "block_stats": run_block_stats,
+    "block_positions": run_block_positions,
+    "core_alignments": run_core_alignments,
+    "mutations_positions": run_mutations_positions,
+    "msu": run_msu,
+    "msu_alignments": run_msu_alignments,
+    "dotplot": run_dotplot,
+    "dotplot_png": run_dotplot_png,
+    "dotplot_tiles": run_dotplot_tiles,
+    "msu_dotplot": run_msu_dotplot,
+}
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    an = Analysis(
+        args.graph,
+        args.seq_lengths,
+        args.out_dir,
+        args.stages,
+        args.table_format,
+        args.threads,
+        args.aln_archive,
+        args.aln_cache,
+        args.aln_cache_gb,
+        args.dotplot_max_copies,
+    )
+    an.out.mkdir(exist_ok=True, parents=True)
+    an.run()
@@ -0,0 +1,177 @@
+import pandas as pd
+import graph_cache as gc
+import seq_lengths as sl
+import concurrent.futures as cf
+import subprocess
+import pathlib
+import argparse
+import json
+import os
+import yaml
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Run many comparisons in a pool of worker processes"
+    )
+    parser.add_argument("--config", type=str, default="config.yaml")
+    parser.add_argument("--data_dir", type=str, default="data")
+    parser.add_argument("--results_dir", type=str, default="results")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument(
+        "--build",
+        action="store_true",
+        help="Build missing graphs with pangraph (otherwise they must exist)",
+    )
+    parser.add_argument(
+        "--comparisons",
+        type=str,
+        nargs="+",
+        help="Subset of comparisons to run (default: all in the config)",
+    )
+    parser.add_argument(
+        "--aln_cache",
+        type=str,
+        help="Shared cache of reconstructed alignments (default: as in the config)",
+    )
+    return parser.parse_args()
+
+
+# ---------------- per-genome cache ----------------
+
+
+def genome_cache_file(genome, results_dir):
+    return pathlib.Path(results_dir) / "genomes" / f"{genome}.json"
+
+
+def genome_info(genome, data_dir, results_dir):
+    """Contig lengths and checksums of a genome. They are computed once and
+    stored in `results/genomes/{genome}.json`, and recomputed only if the
+    fasta file changes."""
+    fasta = pathlib.Path(data_dir) / f"{genome}.fa"
+    cache_file = genome_cache_file(genome, results_dir)
+    sig = gc.source_signature(fasta)
+    if cache_file.exists():
+        with open(cache_file, "r") as f:
+            info = json.load(f)
+        if info["size"] == sig["size"] and info["mtime_ns"] == sig["mtime_ns"]:
+            return info
+
+    info = {"genome": genome, **sig, "contigs": sl.get_seq_info(str(fasta))}
+    cache_file.parent.mkdir(exist_ok=True, parents=True)
+    tmp_file = cache_file.with_name(cache_file.name + ".tmp")
+    with open(tmp_file, "w") as f:
+        json.dump(info, f)
+    os.replace(tmp_file, cache_file)
+    return info
+
+
+def write_seq_lengths(infos, out_file):
+    records = [
+        {k: c[k] for k in ["id", "length", "file", "md5"]}
+        for info in infos
+        for c in info["contigs"]
+    ]
+    pd.DataFrame(records).to_csv(out_file, index=False)
+
+
+# ---------------- per-comparison work ----------------
+
+
+def build_graph(fastas, graph_file):
+    # same parameters as the `build_graph` rule in the Snakefile
+    cmd = ["pangraph", "build", "--circular", "-s", "20", "-a", "100", "-b", "5"]
+    with open(graph_file, "w") as f:
+        subprocess.run(cmd + [str(x) for x in fastas], stdout=f, check=True)
+
+
+def analysis_options(config, aln_cache=None):
+    """Options of `analyze.Analysis`, from the same config keys used by the
+    Snakefile, so that the outputs are the same as in a snakemake run."""
+    if aln_cache is None:
+        aln_cache = config.get("aln_cache", None)
+    return {
+        "table_format": config.get("table_format", "csv"),
+        "threads": config.get("threads", 1),
+        "aln_archive": config.get("aln_archive", False),
+        "aln_cache": aln_cache,
+        "aln_cache_gb": config.get("aln_cache_gb", None),
+        "dotplot_max_copies": config.get("dotplot_max_copies", None),
+    }
+
+
+def run_comparison(comp, genomes, data_dir, results_dir, build, options=None):
+    import analyze
+
+    out_dir = pathlib.Path(results_dir) / comp
+    out_dir.mkdir(exist_ok=True, parents=True)
+    graph_file = out_dir / "graph.json"
+    if not graph_file.exists():
+        if not build:
+            raise FileNotFoundError(f"missing graph {graph_file}, use --build")
+        build_graph([pathlib.Path(data_dir) / f"{g}.fa" for g in genomes], graph_file)
+
+    gc.ensure_cache(graph_file)
+
+    an = analyze.Analysis(
+        graph_file,
+        out_dir / "seq_lengths.csv",
+        out_dir,
+        list(analyze.STAGES),
+        **(options or {}),
+    )
+    an.run()
+    return comp
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    with open(args.config, "r") as f:
+        config = yaml.safe_load(f)
+    comparisons = config["comparisons"]
+    if args.comparisons is not None:
+        comparisons = {k: comparisons[k] for k in args.comparisons}
+
+    options = analysis_options(config, args.aln_cache)
+
+    genomes = sorted({g for gs in comparisons.values() for g in gs})
+
+    with cf.ProcessPoolExecutor(max_workers=args.workers) as pool:
+        # per-genome work, once per genome irrespective of the number of
+        # comparisons it appears in
+        futures = {
+            g: pool.submit(genome_info, g, args.data_dir, args.results_dir)
+            for g in genomes
+        }
+        infos = {g: fut.result() for g, fut in futures.items()}
+
+        for comp, gs in comparisons.items():
+            out_dir = pathlib.Path(args.results_dir) / comp
+            out_dir.mkdir(exist_ok=True, parents=True)
+            write_seq_lengths([infos[g] for g in gs], out_dir / "seq_lengths.csv")
+
+        futures = {
+            pool.submit(
+                run_comparison,
+                comp,
+                gs,
+                args.data_dir,
+                args.results_dir,
+                args.build,
+                options,
+            ): comp
+            for comp, gs in comparisons.items()
+        }
+        failed = []
+        for fut in cf.as_completed(futures):
+            comp = futures[fut]
+            try:
+                fut.result()
+                print(f"{comp}: done")
+            except Exception as e:
+                print(f"{comp}: failed ({e!r})")
+                failed.append(comp)
+
+    if failed:
+        raise SystemExit(f"{len(failed)} comparisons failed: {', '.join(failed)}")
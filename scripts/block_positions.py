@@ -1,4 +1,4 @@
-import pypangraph as pp
+import graph_cache as gc
 import pandas as pd
 import argparse
 
@@ -43,6 +43,6 @@ def block_position_dataframe(pan):
 
 if __name__ == "__main__":
     args = parse_args()
-    pan = pp.Pangraph.load_json(args.graph)
+    pan = gc.load_graph(args.graph, blocks=())
     df = block_position_dataframe(pan)
     df.to_csv(args.output, index=False)
@@ -1,5 +1,5 @@
 import argparse
-import pypangraph as pp
+import graph_cache as gc
 
 
 def parse_args():
@@ -9,9 +9,7 @@ def parse_args():
     return parser.parse_args()
 
 
-if __name__ == "__main__":
-    args = parse_args()
-    pan = pp.Pangraph.load_json(args.graph)
+def block_stats_df(pan):
     bdf = pan.to_blockstats_df()
     bdf = bdf.sort_values(
         ["core", "duplicated", "count", "len"], ascending=[False, True, False, False]
@@ -21,4 +19,11 @@ if __name__ == "__main__":
     bdf.loc[mask, "category"] = "duplicated"
     mask = (~bdf["core"]) & (~bdf["duplicated"])
     bdf.loc[mask, "category"] = "accessory"
+    return bdf
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    pan = gc.load_graph(args.graph, blocks=())
+    bdf = block_stats_df(pan)
     bdf.to_csv(args.out)
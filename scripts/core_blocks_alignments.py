@@ -1,6 +1,11 @@
-import pypangraph as pp
+import graph_cache as gc
+import table_io as tio
+import aln_archive as aa
+import aln_cache as ac
 import pandas as pd
 from Bio import SeqIO, SeqRecord, Seq
+import multiprocessing as mp
+import numpy as np
 import argparse
 import pathlib
 
@@ -19,12 +24,35 @@ def parse_args():
         help="Path to the output folder",
         required=True,
     )
+    parser.add_argument(
+        "--format",
+        type=str,
+        choices=list(tio.FORMATS),
+        default="csv",
+        help="Format of the SNPs, insertions and deletions tables",
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=1,
+        help="Number of worker processes",
+    )
+    parser.add_argument(
+        "--archive",
+        action="store_true",
+        help="Save all alignments in a single indexed archive, not one fasta each",
+    )
+    parser.add_argument(
+        "--aln_cache", type=str, help="Shared cache of reconstructed alignments"
+    )
+    parser.add_argument(
+        "--aln_cache_gb", type=float, help="Size cap of the alignment cache (GB)"
+    )
     args = parser.parse_args()
     return args
 
 
-def create_alignment(aln):
-    A, O = aln.generate_alignments()
+def create_alignment(A, O):
     records = []
     for a, o in zip(A, O):
         seq = Seq.Seq(a)
@@ -34,7 +62,7 @@ def create_alignment(aln):
     return records
 
 
-def extract_variations(aln):
+def extract_variations(cb, aln):
     M, I, D = [], [], []
 
     for k, ms in aln.muts.items():
@@ -60,14 +88,60 @@ def extract_variations(aln):
     return M, I, D
 
 
-if __name__ == "__main__":
+def process_blocks(pan, blocks, corealn_fld, archive=False, cache=None, digests=None):
+    """Create and save the alignment of each block, and return the list
+    of SNPs, insertions and deletions. With `archive` alignments are not
+    saved but returned compressed, as (block id, data) pairs. With `cache`
+    (an `AlignmentCache`) alignments of blocks with a known digest are
+    reused across runs and stages."""
+    digests = {} if digests is None else digests
+    snps, ins, dels, alns = [], [], [], []
+    for cb in blocks:
+        block = pan.blocks[cb]
+        aln = block.alignment
 
-    args = parse_args()
+        # create and save alignment
+        A, O = ac.generate_alignments(cb, aln, digests.get(cb), cache)
+        aln_records = create_alignment(A, O)
+        if archive:
+            alns.append((cb, aa.compress(aa.fasta_text(aln_records))))
+        else:
+            aln_file = corealn_fld / f"{cb}.fa"
+            SeqIO.write(aln_records, aln_file, "fasta")
 
-    pan = pp.Pangraph.load_json(args.graph)
+        # record mutations
+        M, I, D = extract_variations(cb, aln)
+        snps += M
+        ins += I
+        dels += D
+    return snps, ins, dels, alns
 
-    aln_fld = pathlib.Path(args.out_fld)
-    aln_fld.mkdir(exist_ok=True, parents=True)
+
+# state shared with the worker processes. Set before the pool is created,
+# so that forked workers inherit the graph instead of receiving a copy.
+_worker_state = {}
+
+
+def _process_chunk(blocks):
+    S = _worker_state
+    return process_blocks(
+        S["pan"], blocks, S["fld"], S["archive"], S["cache"], S["digests"]
+    )
+
+
+def core_alignments(pan, aln_fld, threads=1, archive=False, cache=None, digests=None):
+    """Save the alignment of every core block in `aln_fld/core_alignments`
+    and return the SNPs, insertions and deletions dataframes. With
+    `threads` > 1 blocks are split in contiguous chunks across worker
+    processes, and results are concatenated in chunk order: the output is
+    identical to the serial one. With `archive` the alignments are stored
+    in a single archive `core_alignments/alignments.alnz`. Reconstructed
+    alignments are taken from and saved to the alignment `cache`, if any,
+    using the block `digests` (by default taken from the graph)."""
+    aln_fld = pathlib.Path(aln_fld)
+
+    if digests is None:
+        digests = {} if cache is None else ac.block_digests(pan)
 
     # select core blocks
     bdf = pan.to_blockstats_df()
@@ -78,23 +152,29 @@ if __name__ == "__main__":
     # and add mutations to dataframes
     corealn_fld = aln_fld / "core_alignments"
     corealn_fld.mkdir(exist_ok=True, parents=True)
-    snps, ins, dels = [], [], []
-    for cb in core_blocks:
-        block = pan.blocks[cb]
-        aln = block.alignment
-
-        # create and save alignment
-        aln_records = create_alignment(aln)
-        aln_file = corealn_fld / f"{cb}.fa"
-        SeqIO.write(aln_records, aln_file, "fasta")
-
-        # record mutations
-        M, I, D = extract_variations(aln)
-        snps += M
-        ins += I
-        dels += D
-
-    # finalize and save mutation dataframes
+    if threads > 1 and len(core_blocks) > 1:
+        # a few chunks per worker, to balance blocks of different sizes
+        chunks = np.array_split(core_blocks, min(len(core_blocks), 4 * threads))
+        _worker_state.update(
+            pan=pan, fld=corealn_fld, archive=archive, cache=cache, digests=digests
+        )
+        try:
+            with mp.get_context("fork").Pool(threads) as pool:
+                results = pool.map(_process_chunk, chunks, chunksize=1)
+        finally:
+            _worker_state.clear()
+        snps, ins, dels, alns = ([x for r in results for x in r[k]] for k in range(4))
+    else:
+        snps, ins, dels, alns = process_blocks(
+            pan, core_blocks, corealn_fld, archive, cache, digests
+        )
+
+    if archive:
+        with aa.ArchiveWriter(corealn_fld / aa.ARCHIVE_NAME) as aw:
+            for cb, data in alns:
+                aw.add_compressed(cb, data)
+
+    # finalize mutation dataframes
     snps = pd.DataFrame(
         snps,
         columns=[
@@ -130,7 +210,30 @@ if __name__ == "__main__":
             "del_len",
         ],
     )
+    return snps, ins, dels
 
-    snps.to_csv(aln_fld / "snps.csv")
-    ins.to_csv(aln_fld / "ins.csv")
-    dels.to_csv(aln_fld / "dels.csv")
+
+def save_variations(snps, ins, dels, aln_fld, fmt="csv"):
+    aln_fld = pathlib.Path(aln_fld)
+    ext = tio.FORMATS[fmt]
+    for df, name in [(snps, "snps"), (ins, "ins"), (dels, "dels")]:
+        fname = aln_fld / f"{name}{ext}"
+        tio.write_table(df, fname, index=True, partition_by="block_id")
+
+
+if __name__ == "__main__":
+
+    args = parse_args()
+
+    pan = gc.load_graph(args.graph, alignments=True, blocks="core")
+
+    aln_fld = pathlib.Path(args.out_fld)
+    aln_fld.mkdir(exist_ok=True, parents=True)
+
+    cache = ac.open_cache(args.aln_cache, args.aln_cache_gb)
+    # the streamed graph carries no digests: take them from the binary cache
+    digests = None if cache is None else ac.block_digests(pan, args.graph)
+    snps, ins, dels = core_alignments(
+        pan, aln_fld, args.threads, args.archive, cache, digests
+    )
+    save_variations(snps, ins, dels, aln_fld, args.format)
@@ -1,6 +1,7 @@
-import pypangraph as pp
+import graph_cache as gc
+import numpy as np
 import pandas as pd
-from collections import defaultdict
+from collections import defaultdict, Counter
 import itertools as itt
 import plotly.graph_objects as go
 import plotly.subplots as sp
@@ -12,7 +13,23 @@ def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument("--graph", type=str, help="Pangraph JSON file")
     parser.add_argument("--seq_lengths", type=str, help="Sequence lengths CSV file")
-    parser.add_argument("--output", type=str, help="Output HTML file")
+    parser.add_argument(
+        "--output",
+        type=str,
+        help="Output file: interactive HTML, or a raster image if it ends in .png",
+    )
+    parser.add_argument(
+        "--max_copies",
+        type=int,
+        help="Duplicated families with more copies than this in either genome "
+        "are drawn as binned density cells instead of single segments",
+    )
+    parser.add_argument(
+        "--n_bins", type=int, default=500, help="Number of bins per axis of the cells"
+    )
+    parser.add_argument(
+        "--px", type=int, default=1000, help="Size in pixels of the png dotplot"
+    )
     return parser.parse_args()
 
 
@@ -32,64 +49,218 @@ def position_dictionary(pan):
     return pos
 
 
-def display_line(bid, seg, color, lg, text, fig):
-    kwargs = dict(color=color, lg=lg, text=text, fig=fig)
-    if seg.x_runover():
-        for s in seg.split_x():
-            display_line(bid, s, **kwargs)
-    elif seg.y_runover():
-        for s in seg.split_y():
-            display_line(bid, s, **kwargs)
-    else:
-        if seg.e1 == 0:
-            seg.e1 = seg.L1
-        if seg.e2 == 0:
-            seg.e2 = seg.L2
-        fig.add_trace(
-            go.Scatter(
-                x=seg.x(),
-                y=seg.y(),
-                mode="markers+lines",
-                marker=dict(color=color, size=2),
-                line=dict(color=color),
-                name=f"{bid}",
-                text=text,
-                hoverinfo="text",
-                legendgroup=lg,
-                showlegend=False,
-            ),
-            row=1,
-            col=2,
-        )
+class TraceBatch:
+    """Segments collected by legend group and subplot, and drawn at the end
+    with a single WebGL trace each. Consecutive segments are separated by
+    a gap (NaN), and every point carries the hover text of its segment."""
 
+    def __init__(self):
+        self.traces = defaultdict(lambda: {"x": [], "y": [], "text": []})
 
-def display_private_line(bid, seg, color, lg, text, fig, kind):
-    if seg.s > seg.e:
-        for s in seg.split_x():
-            display_private_line(bid, s, color, lg, text, fig, kind)
-    else:
-        x = seg.x() if kind == "x" else [0, 0]
-        y = seg.x() if kind == "y" else [0, 0]
-        r, c = (2, 2) if kind == "x" else (1, 1)
+    def add(self, x0, x1, y0, y1, text, lg, row, col):
+        t = self.traces[(lg, row, col)]
+        t["x"].append(su.line_coords(x0, x1))
+        t["y"].append(su.line_coords(y0, y1))
+        text = np.asarray(text, dtype=object)
+        t["text"].append(np.stack([text, text, np.full(len(text), None)], 1).ravel())
+
+    def add_pieces(self, pieces, text, lgs, row, col):
+        """Add the pieces (x0, x1, y0, y1, idx) of split segments, where
+        `text` and `lgs` are the hover text and legend group of each
+        segment."""
+        x0, x1, y0, y1, idx = pieces
+        text, lgs = np.asarray(text, dtype=object)[idx], np.asarray(lgs)[idx]
+        for lg in pd.unique(lgs):
+            m = lgs == lg
+            self.add(x0[m], x1[m], y0[m], y1[m], text[m], lg, row, col)
+
+    def draw(self, fig, colors):
+        for (lg, row, col), t in self.traces.items():
+            color = colors[lg]
+            fig.add_trace(
+                go.Scattergl(
+                    x=np.concatenate(t["x"]),
+                    y=np.concatenate(t["y"]),
+                    mode="markers+lines",
+                    marker=dict(color=color, size=2),
+                    line=dict(color=color),
+                    name=lg,
+                    text=np.concatenate(t["text"]),
+                    hoverinfo="text",
+                    legendgroup=lg,
+                    showlegend=False,
+                ),
+                row=row,
+                col=col,
+            )
+
+
+class FamilyGrid:
+    """Occurrence pairs of large duplicated families, counted on a grid of
+    `n_bins` x `n_bins` cells instead of being drawn one by one. Adding a
+    family costs its number of occupied rows times occupied columns, which
+    is bounded by the grid size rather than by the square of the copy
+    number. Each cell is drawn once, with the families it contains in the
+    hover text."""
+
+    def __init__(self, L1, L2, n_bins):
+        self.L1, self.L2, self.n_bins = L1, L2, n_bins
+        self.cells = defaultdict(Counter)
+
+    def bin_counts(self, occs, L):
+        n = self.n_bins
+        return Counter(min(int(start) * n // L, n - 1) for start, *_ in occs)
+
+    def add(self, bid, l1, l2):
+        c1 = self.bin_counts(l1, self.L1)
+        c2 = self.bin_counts(l2, self.L2)
+        for i, n1 in c1.items():
+            for j, n2 in c2.items():
+                self.cells[(i, j)][bid] += n1 * n2
+
+    def draw(self, fig, lg, max_families=10):
+        if not self.cells:
+            return
+        n = self.n_bins
+        ij = np.array(list(self.cells.keys()))
+        x = (ij[:, 0] + 0.5) * self.L1 / n
+        y = (ij[:, 1] + 0.5) * self.L2 / n
+        counts = np.array([sum(fams.values()) for fams in self.cells.values()])
+        text = []
+        for k, fams in zip(counts, self.cells.values()):
+            lines = [f"{bid}: {c}" for bid, c in fams.most_common(max_families)]
+            if len(fams) > max_families:
+                lines.append(f"... {len(fams) - max_families} more families")
+            text.append(f"{k} duplicated pairs<br>" + "<br>".join(lines))
         fig.add_trace(
-            go.Scatter(
+            go.Scattergl(
                 x=x,
                 y=y,
-                mode="markers+lines",
-                marker=dict(color=color, size=2),
-                line=dict(color=color),
-                name=f"{bid}",
+                mode="markers",
+                marker=dict(
+                    symbol="square",
+                    size=4,
+                    color=np.log10(counts),
+                    colorscale="Greys",
+                    cmin=-0.5,
+                ),
+                name=f"{lg} (binned)",
                 text=text,
                 hoverinfo="text",
                 legendgroup=lg,
                 showlegend=False,
             ),
-            row=r,
-            col=c,
+            row=1,
+            col=2,
         )
 
 
-def create_dotplot(pos, Ls):
+def legend_colors(p1, p2):
+    return {
+        "fwd": "blue",
+        "inverted": "red",
+        "dupl": "gray",
+        f"private {p1}": "green",
+        f"private {p2}": "goldenrod",
+    }
+
+
+def shared_segments(pos, Ls, families):
+    """Segments between every pair of occurrences of the shared blocks in
+    `families`, with the hover text and legend group of each segment."""
+    p1, p2 = list(pos.keys())
+    segs = defaultdict(list)
+    for bid in families:
+        l1 = pos[p1][bid]
+        l2 = pos[p2][bid]
+
+        dupl = len(l1) > 1 or len(l2) > 1
+        for a1, a2 in itt.product(l1, l2):
+            start1, end1, strand1, occ1 = a1
+            start2, end2, strand2, occ2 = a2
+
+            pm1 = "+" if strand1 == 1 else "-"
+            pm2 = "+" if strand2 == 1 else "-"
+            text = f"{bid} # {pm1}|{occ1} vs {pm2}|{occ2}"
+
+            orient = strand1 == strand2
+
+            if dupl:
+                lg = "dupl"
+            else:
+                lg = "fwd" if orient else "inverted"
+
+            for k, v in zip(
+                ["s1", "e1", "s2", "e2", "orient", "text", "lg"],
+                [start1, end1, start2, end2, orient, text, lg],
+            ):
+                segs[k].append(v)
+
+    seg = su.SegmentArray(
+        segs["s1"], segs["e1"], segs["s2"], segs["e2"], segs["orient"], Ls[p1], Ls[p2]
+    )
+    return seg, segs["text"], segs["lg"]
+
+
+def occurrences(pos, pid, families):
+    rows = [(bid, *a) for bid in families for a in pos[pid][bid]]
+    cols = ["bid", "start", "end", "strand", "occ"]
+    # built by column, much faster than from rows of numpy scalars
+    return pd.DataFrame(
+        {c: np.array(v) for c, v in zip(cols, zip(*rows))}, columns=cols
+    )
+
+
+def segment_pairs(pos, Ls, families):
+    """Same segments as `shared_segments`, without the hover text. Pairs of
+    occurrences are found with a join on the block id, which is much faster
+    for families with many copies. Returns the segments and the legend
+    group of each."""
+    p1, p2 = list(pos.keys())
+    o1 = occurrences(pos, p1, families)
+    o2 = occurrences(pos, p2, families)
+    df = o1.merge(o2, on="bid", suffixes=("1", "2"))
+
+    n1, n2 = o1["bid"].value_counts(), o2["bid"].value_counts()
+    dupl = (df["bid"].map(n1) > 1) | (df["bid"].map(n2) > 1)
+    orient = df["strand1"] == df["strand2"]
+    lgs = np.where(dupl, "dupl", np.where(orient, "fwd", "inverted"))
+
+    seg = su.SegmentArray(
+        df["start1"], df["end1"], df["start2"], df["end2"], orient, Ls[p1], Ls[p2]
+    )
+    return seg, lgs
+
+
+def private_segments(pos, Ls, pid):
+    """Intervals of the blocks that occur only in genome `pid`, with the
+    hover text and legend group of each interval."""
+    private = set(pos[pid].keys())
+    for other in pos:
+        if other != pid:
+            private -= set(pos[other].keys())
+    privs = defaultdict(list)
+    for bid in private:
+        l = pos[pid][bid]
+        dupl = len(l) > 1
+        for a in l:
+            start, end, strand, occ = a
+            pm = "+" if strand == 1 else "-"
+            text = f"{bid} # {pm}|{occ}"
+
+            if dupl:
+                lg = "dupl"
+            else:
+                lg = f"private {pid}"
+
+            for k, v in zip(["s", "e", "text", "lg"], [start, end, text, lg]):
+                privs[k].append(v)
+
+    seg = su.PrivSegmentArray(privs["s"], privs["e"], Ls[pid])
+    return seg, privs["text"], privs["lg"]
+
+
+def create_dotplot(pos, Ls, max_copies=None, n_bins=500):
     # Create the plotly figure
     fig = sp.make_subplots(
         2,
@@ -104,13 +275,7 @@ def create_dotplot(pos, Ls):
 
     p1, p2 = list(pos.keys())
 
-    colors = {
-        "fwd": "blue",
-        "inverted": "red",
-        "dupl": "gray",
-        f"private {p1}": "green",
-        f"private {p2}": "goldenrod",
-    }
+    colors = legend_colors(p1, p2)
 
     for lg, color in colors.items():
         fig.add_trace(
@@ -127,50 +292,33 @@ def create_dotplot(pos, Ls):
             col=2,
         )
 
+    batch = TraceBatch()
+    grid = FamilyGrid(Ls[p1], Ls[p2], n_bins)
     shared = set(pos[p1].keys()) & set(pos[p2].keys())
-    for bid in shared:
-        l1 = pos[p1][bid]
-        l2 = pos[p2][bid]
+    # large duplicated families are aggregated
+    large = set()
+    if max_copies is not None:
+        for bid in shared:
+            l1, l2 = pos[p1][bid], pos[p2][bid]
+            if max(len(l1), len(l2)) > max_copies:
+                grid.add(bid, l1, l2)
+                large.add(bid)
 
-        dupl = len(l1) > 1 or len(l2) > 1
-        for a1, a2 in itt.product(l1, l2):
-            start1, end1, strand1, occ1 = a1
-            start2, end2, strand2, occ2 = a2
+    # split all segments at the genome boundaries at once
+    seg, text, lgs = shared_segments(pos, Ls, shared - large)
+    batch.add_pieces(seg.split(), text, lgs, row=1, col=2)
 
-            pm1 = "+" if strand1 == 1 else "-"
-            pm2 = "+" if strand2 == 1 else "-"
-            text = f"{bid} # {pm1}|{occ1} vs {pm2}|{occ2}"
-
-            orient = strand1 == strand2
-
-            if dupl:
-                lg = "dupl"
-            else:
-                lg = "fwd" if orient else "inverted"
+    for pid, kind in [(p1, "x"), (p2, "y")]:
+        seg, text, lgs = private_segments(pos, Ls, pid)
+        # private blocks are drawn along the axis of their genome
+        x0, x1, idx = seg.split()
+        zero = np.zeros(len(idx))
+        pieces = (x0, x1, zero, zero, idx) if kind == "x" else (zero, zero, x0, x1, idx)
+        r, c = (2, 2) if kind == "x" else (1, 1)
+        batch.add_pieces(pieces, text, lgs, row=r, col=c)
 
-            seg = su.Segment(start1, end1, start2, end2, orient, Ls[p1], Ls[p2])
-            color = colors[lg]
-            display_line(bid, seg, color, lg, text, fig)
-
-    private_1 = set(pos[p1].keys()) - set(pos[p2].keys())
-    private_2 = set(pos[p2].keys()) - set(pos[p1].keys())
-    for private, pid, kind in [(private_1, p1, "x"), (private_2, p2, "y")]:
-        for bid in private:
-            l = pos[pid][bid]
-            dupl = len(l) > 1
-            for a in l:
-                start, end, strand, occ = a
-                seg = su.PrivSegment(start, end, Ls[pid])
-                pm = "+" if strand == 1 else "-"
-                text = f"{bid} # {pm}|{occ}"
-
-                if dupl:
-                    lg = "dupl"
-                else:
-                    lg = f"private {pid}"
-
-                color = colors[lg]
-                display_private_line(bid, seg, color, lg, text, fig, kind)
+    batch.draw(fig, colors)
+    grid.draw(fig, "dupl")
 
     # Update layout for better appearance
     fig.update_layout(
@@ -186,15 +334,97 @@ def create_dotplot(pos, Ls):
     return fig
 
 
-if __name__ == "__main__":
-    args = parse_args()
+def dotplot(pan, Ls, max_copies=None, n_bins=500):
+    Ls = {k: v for k, v in Ls.items() if k in pan.strains()}
+    pos = position_dictionary(pan)
+    return create_dotplot(pos, Ls, max_copies, n_bins)
 
-    pan = pp.Pangraph.load_json(args.graph)
-    bdf = pan.to_blockstats_df()
 
-    Ls = pd.read_csv(args.seq_lengths).set_index("id")["length"].to_dict()
+# raster dotplot: legend groups in drawing order
+RASTER_ORDER = ["dupl", "fwd", "inverted"]
+
+
+def pixel_index(x, L, px):
+    return np.minimum((x * px / L).astype(np.int64), px - 1)
+
+
+def group_codes(lgs, idx):
+    # integer code of the legend group of each point, faster to compare
+    # than strings
+    codes, names = pd.factorize(np.asarray(lgs, dtype=object))
+    return codes[idx], {lg: k for k, lg in enumerate(names)}
+
+
+def frame(img, color=(180, 180, 180)):
+    img[[0, -1], :] = color
+    img[:, [0, -1]] = color
+
+
+def raster_dotplot(pan, Ls, px=1000):
+    """Dotplot as an RGB image, drawn directly on a pixel grid. The main
+    panel has px x px pixels, with the private blocks of the two genomes on
+    strips below and to the left, as in `create_dotplot`. Segments are
+    split at the genome boundaries and sampled at half-pixel steps, so that
+    the cost is proportional to the number of segments and to their length
+    in pixels."""
+    from PIL import ImageColor
+
     Ls = {k: v for k, v in Ls.items() if k in pan.strains()}
     pos = position_dictionary(pan)
+    p1, p2 = list(pos.keys())
+    L1, L2 = Ls[p1], Ls[p2]
+    colors = {lg: ImageColor.getrgb(c) for lg, c in legend_colors(p1, p2).items()}
 
-    fig = create_dotplot(pos, Ls)
-    fig.write_html(args.output)
+    strip, gap = max(px // 20, 4), 3
+    img = np.full((px + gap + strip, strip + gap + px, 3), 255, dtype=np.uint8)
+    main = img[:px, strip + gap :]
+    strip_x = img[px + gap :, strip + gap :]
+    strip_y = img[:px, :strip]
+
+    shared = set(pos[p1].keys()) & set(pos[p2].keys())
+    seg, lgs = segment_pairs(pos, Ls, shared)
+    x0, x1, y0, y1, idx = seg.split()
+    x, y, _, sidx = su.line_samples(x0, x1, y0, y1, L1 / px, L2 / px)
+    ix = pixel_index(x, L1, px)
+    iy = px - 1 - pixel_index(y, L2, px)
+    codes, ids = group_codes(lgs, idx[sidx])
+    for lg in RASTER_ORDER:
+        m = codes == ids.get(lg, -1)
+        main[iy[m], ix[m]] = colors[lg]
+
+    for pid, L, panel in [(p1, L1, strip_x), (p2, L2, strip_y)]:
+        seg, _, lgs = private_segments(pos, Ls, pid)
+        x0, x1, idx = seg.split()
+        zero = np.zeros(len(x0))
+        x, _, _, sidx = su.line_samples(x0, x1, zero, zero, L / px, 1)
+        i = pixel_index(x, L, px)
+        codes, ids = group_codes(lgs, idx[sidx])
+        for lg in ["dupl", f"private {pid}"]:
+            m = codes == ids.get(lg, -1)
+            if panel is strip_x:
+                panel[:, i[m]] = colors[lg]
+            else:
+                panel[px - 1 - i[m], :] = colors[lg]
+
+    for panel in [main, strip_x, strip_y]:
+        frame(panel)
+    return img
+
+
+def write_png(img, fname):
+    from PIL import Image
+
+    Image.fromarray(img).save(fname)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    pan = gc.load_graph(args.graph, blocks=())
+
+    Ls = pd.read_csv(args.seq_lengths).set_index("id")["length"].to_dict()
+    if args.output.endswith(".png"):
+        write_png(raster_dotplot(pan, Ls, args.px), args.output)
+    else:
+        fig = dotplot(pan, Ls, args.max_copies, args.n_bins)
+        fig.write_html(args.output)
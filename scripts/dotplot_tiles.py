@@ -0,0 +1,193 @@
+import graph_cache as gc
+import numpy as np
+import pandas as pd
+import dotplot as dp
+import segment_utils as su
+import pathlib
+import argparse
+import shutil
+import json
+
+VIEWER = pathlib.Path(__file__).parent / "dotplot_viewer.html"
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Pre-tiled multi-resolution dotplot, with a local viewer"
+    )
+    parser.add_argument("--graph", type=str, help="Pangraph JSON file")
+    parser.add_argument("--seq_lengths", type=str, help="Sequence lengths CSV file")
+    parser.add_argument("--out_dir", type=str, help="Output folder")
+    parser.add_argument(
+        "--levels",
+        type=int,
+        default=6,
+        help="Number of zoom levels. Level z has 2^z x 2^z tiles.",
+    )
+    parser.add_argument(
+        "--tile_bins", type=int, default=256, help="Number of bins per tile side"
+    )
+    return parser.parse_args()
+
+
+def bin_index(x, L, n_bins):
+    return np.minimum((x * n_bins / L).astype(np.int64), n_bins - 1)
+
+
+def aggregate(keys, w):
+    # sum of the weights of equal keys
+    keys, inv = np.unique(keys, return_inverse=True)
+    return keys, np.bincount(inv.ravel(), weights=w)
+
+
+class Pyramid:
+    """Binned bp of segments, for each legend group, on a grid of
+    `tile_bins * 2^z` bins per axis at every level z. Bins are computed at
+    the finest level and summed into the coarser ones. Only non-empty bins
+    are stored, as (x bin, y bin, bp) arrays."""
+
+    def __init__(self, L1, L2, levels, tile_bins):
+        self.L1, self.L2 = L1, L2
+        self.levels, self.tile_bins = levels, tile_bins
+        self.n_bins = tile_bins << (levels - 1)
+        self.bins = {}
+        self.tracks = {}
+
+    def add_pieces(self, pieces, lgs):
+        x0, x1, y0, y1, idx = pieces
+        lgs = np.asarray(lgs)[idx]
+        bx, by = self.L1 / self.n_bins, self.L2 / self.n_bins
+        x, y, w, sidx = su.line_samples(x0, x1, y0, y1, bx, by)
+        ix = bin_index(x, self.L1, self.n_bins)
+        iy = bin_index(y, self.L2, self.n_bins)
+        for lg in pd.unique(lgs):
+            m = lgs[sidx] == lg
+            keys, v = aggregate(ix[m] * self.n_bins + iy[m], w[m])
+            self.bins[lg] = (keys // self.n_bins, keys % self.n_bins, v)
+
+    def add_track(self, pieces, lgs, axis):
+        # private blocks, binned along the axis of their genome only
+        x0, x1, idx = pieces
+        lgs = np.asarray(lgs)[idx]
+        L = self.L1 if axis == "x" else self.L2
+        zero = np.zeros(len(x0))
+        x, _, w, sidx = su.line_samples(x0, x1, zero, zero, L / self.n_bins, 1)
+        ix = bin_index(x, L, self.n_bins)
+        for lg in pd.unique(lgs):
+            m = lgs[sidx] == lg
+            self.tracks[(axis, lg)] = aggregate(ix[m], w[m])
+
+    def level(self, z):
+        """Bins of level z, for each legend group."""
+        s = self.levels - 1 - z
+        n = self.tile_bins << z
+        res = {}
+        for lg, (ix, iy, v) in self.bins.items():
+            keys, vz = aggregate((ix >> s) * n + (iy >> s), v)
+            res[lg] = (keys // n, keys % n, vz)
+        return res
+
+    def level_tracks(self, z):
+        s = self.levels - 1 - z
+        res = {"x": {}, "y": {}}
+        for (axis, lg), (ix, v) in self.tracks.items():
+            res[axis][lg] = aggregate(ix >> s, v)
+        return res
+
+
+def rounded(v):
+    # bp per bin, as integers (at least 1 for non-empty bins)
+    return np.maximum(np.rint(v), 1).astype(np.int64)
+
+
+def tiles(bins, tile_bins):
+    """Split the bins of one level into tiles. Returns {(tx, ty): {lg: flat
+    list of (x bin, y bin, bp) in the tile}}."""
+    res = {}
+    for lg, (ix, iy, v) in bins.items():
+        tx, ty = ix // tile_bins, iy // tile_bins
+        df = pd.DataFrame(
+            {
+                "tx": tx,
+                "ty": ty,
+                "i": ix % tile_bins,
+                "j": iy % tile_bins,
+                "v": rounded(v),
+            }
+        )
+        for (a, b), t in df.groupby(["tx", "ty"]):
+            flat = t[["i", "j", "v"]].to_numpy().ravel().tolist()
+            res.setdefault((int(a), int(b)), {})[lg] = flat
+    return res
+
+
+def flat_track(i, v):
+    return np.stack([i, rounded(v)], 1).ravel().tolist()
+
+
+def pyramid(pan, Ls, levels=6, tile_bins=256):
+    Ls = {k: v for k, v in Ls.items() if k in pan.strains()}
+    pos = dp.position_dictionary(pan)
+    p1, p2 = list(pos.keys())
+    pyr = Pyramid(Ls[p1], Ls[p2], levels, tile_bins)
+
+    shared = set(pos[p1].keys()) & set(pos[p2].keys())
+    seg, lgs = dp.segment_pairs(pos, Ls, shared)
+    pyr.add_pieces(seg.split(), lgs)
+    for pid, axis in [(p1, "x"), (p2, "y")]:
+        seg, _, lgs = dp.private_segments(pos, Ls, pid)
+        pyr.add_track(seg.split(), lgs, axis)
+    return pyr, (p1, p2)
+
+
+def write_tiles(pyr, names, out_dir):
+    """Save the pyramid as static files, next to the viewer:
+    - `index.json`: genomes, lengths, colors and list of non-empty tiles
+    - `tiles/{z}/{tx}_{ty}.json`: bins of each tile, by legend group
+    - `tracks/{z}.json`: bins of the private blocks, by axis and legend group
+    """
+    out_dir = pathlib.Path(out_dir)
+    out_dir.mkdir(exist_ok=True, parents=True)
+    # remove the tiles of previous runs
+    for fld in ["tiles", "tracks"]:
+        shutil.rmtree(out_dir / fld, ignore_errors=True)
+
+    p1, p2 = names
+    index = {
+        "names": [p1, p2],
+        "lengths": [int(pyr.L1), int(pyr.L2)],
+        "levels": pyr.levels,
+        "tile_bins": pyr.tile_bins,
+        "colors": dp.legend_colors(p1, p2),
+        "tiles": {},
+    }
+    for z in range(pyr.levels):
+        fld = out_dir / "tiles" / str(z)
+        fld.mkdir(exist_ok=True, parents=True)
+        level_tiles = tiles(pyr.level(z), pyr.tile_bins)
+        for (tx, ty), data in level_tiles.items():
+            with open(fld / f"{tx}_{ty}.json", "w") as f:
+                json.dump(data, f, separators=(",", ":"))
+        index["tiles"][z] = sorted(level_tiles)
+
+        tracks = {
+            axis: {lg: flat_track(i, v) for lg, (i, v) in t.items()}
+            for axis, t in pyr.level_tracks(z).items()
+        }
+        (out_dir / "tracks").mkdir(exist_ok=True)
+        with open(out_dir / "tracks" / f"{z}.json", "w") as f:
+            json.dump(tracks, f, separators=(",", ":"))
+
+    with open(out_dir / "index.json", "w") as f:
+        json.dump(index, f)
+    shutil.copy(VIEWER, out_dir / "index.html")
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    pan = gc.load_graph(args.graph, blocks=())
+
+    Ls = pd.read_csv(args.seq_lengths).set_index("id")["length"].to_dict()
+    pyr, names = pyramid(pan, Ls, args.levels, args.tile_bins)
+    write_tiles(pyr, names, args.out_dir)
@@ -1,212 +1,204 @@
+import numpy as np
 import pandas as pd
-from dataclasses import dataclass
+import hashlib
 
-verbose = False
 
+def nodes_signature(nodes):
+    """Signature of a set of glued nodes (one per path), from a digest of
+    their block id, strand and occurrence number. Unlike `hash` it is the
+    same in every run, so that the MSU table is reproducible."""
+    key = "|".join(str(x) for n in nodes for x in n).encode()
+    digest = hashlib.blake2b(key, digest_size=8).digest()
+    # non-negative, fits an int64 column
+    return int.from_bytes(digest, "big") >> 1
 
-def vprint(*args, indent=0, **kwargs):
-    if verbose:
-        print("--" * indent + " ", *args, **kwargs)
 
-
-@dataclass(frozen=True)
-class Node:
-    bid: str
-    strand: bool
-    occ: int
-
-    def __repr__(self) -> str:
-        s = "+" if self.strand else "-"
-        return f"[{self.bid}|{s}|{self.occ}]"
-
-    def gluable(self, other: object) -> bool:
-        return self.bid == other.bid and self.strand == other.strand
-
-    def invert(self) -> "Node":
-        return Node(self.bid, not self.strand, self.occ)
-
-    def anonymous_hash(self) -> int:
-        return hash((self.bid, self.strand))
-
-
-@dataclass(frozen=True, unsafe_hash=False, eq=False)
-class Edge:
-    node1: Node
-    node2: Node
-
-    def invert(self) -> "Edge":
-        return Edge(self.node2.invert(), self.node1.invert())
-
-    def __side_eq__(self, value: object) -> bool:
-        return self.node1.gluable(value.node1) and self.node2.gluable(value.node2)
-
-    def __eq__(self, value: object) -> bool:
-        return self.__side_eq__(value) or self.__side_eq__(value.invert())
-
-    def __side_hash__(self) -> int:
-        return hash((self.node1.anonymous_hash(), self.node2.anonymous_hash()))
-
-    def __hash__(self) -> int:
-        return self.__side_hash__() + self.invert().__side_hash__()
-
-
-@dataclass(init=False, unsafe_hash=False, eq=False)
 class Path:
-    nodes: list[Node]
-    node_pos: dict[Node, int]
-    msu: list[int]
-    signature: list[int]
-
-    def __init__(self, nodes: list[Node]) -> None:
-        self.nodes = nodes
-        self.node_pos = {n: i for i, n in enumerate(nodes)}
-        self.msu = [0] * len(nodes)
-        self.signature = [0] * len(nodes)
-
-    def __repr__(self) -> str:
-        return "---".join([str(n) for n in self.nodes])
-
-    @staticmethod
-    def from_pangraph_path(path) -> "Path":
-        B = path.block_ids
-        S = path.block_strands
-        O = path.block_nums
-        nodes = [Node(b, s, o) for b, s, o in zip(B, S, O)]
-        return Path(nodes)
-
-    def node_idx(self, node: Node) -> int:
-        return self.node_pos[node]
-
-    def next_node_idx(self, node: Node, fwd: bool) -> int:
-        pos = self.node_pos[node]
-        if fwd:
-            return (pos + 1) % len(self.nodes)
-        else:
-            return (pos - 1) % len(self.nodes)
-
-    def next_node(self, node: Node, fwd: bool) -> Node:
-        return self.nodes[self.next_node_idx(node, fwd)]
-
-    def next_edge(self, node: Node, fwd: bool) -> Edge:
-        if fwd:
-            return Edge(node, self.next_node(node, fwd))
-        else:
-            return Edge(self.next_node(node, fwd), node)
-
-    def get_msu(self, node: Node) -> int:
-        return self.msu[self.node_pos[node]]
-
-    def set_msu(self, node: Node, msu_id: int, signature: int) -> None:
-        idx = self.node_pos[node]
-        self.msu[idx] = msu_id
-        self.signature[idx] = signature
-
-    def remap_msu(self, old_id: int, new_id: int) -> None:
-        for i, msu in enumerate(self.msu):
-            if msu == old_id:
-                self.msu[i] = new_id
-
-    def to_df(self) -> pd.DataFrame:
-        data = [n.__dict__ for n in self.nodes]
-        df = pd.DataFrame(data)
-        df["msu"] = self.msu
-        df["signature"] = self.signature
-        return df
-
-
-def pan_to_paths(pan):
+    """A path with nodes stored as integer arrays, indexed by their position
+    along the path. Block ids are interned to the integers of `block_idx`,
+    shared by all paths. A node with strand s of block b has the oriented
+    key 2*b + s, so that inverting a node flips the last bit."""
+
+    def __init__(self, name, bids, strands, occs, block_idx):
+        self.name = name
+        self.bids = np.asarray(bids)
+        self.strands = np.asarray(strands, dtype=bool)
+        self.occs = np.asarray(occs)
+        self.N = len(self.bids)
+
+        block = np.array([block_idx[b] for b in self.bids], dtype=np.int64)
+        node = 2 * block + self.strands
+        nxt = np.roll(node, -1)
+        # key of the edge between node i and node i+1. The edge is the same
+        # when read in the opposite direction on inverted nodes, so the key
+        # is the smallest of the two readings. Occurrence numbers are
+        # ignored: edges only need to be gluable.
+        M = 2 * len(block_idx)
+        edge = np.minimum(node * M + nxt, (nxt ^ 1) * M + (node ^ 1))
+        self.edge = edge.tolist()
+
+        self.msu = [0] * self.N
+        self.signature = [0] * self.N
+
+    def node(self, i):
+        return (str(self.bids[i]), bool(self.strands[i]), int(self.occs[i]))
+
+    def next_edge(self, i, fwd):
+        # edge between node i and the next node in direction `fwd`
+        return self.edge[i] if fwd else self.edge[(i - 1) % self.N]
+
+    def next_idx(self, i, fwd):
+        return (i + 1) % self.N if fwd else (i - 1) % self.N
+
+    def index(self, blocks):
+        """Position of the (single) occurrence of each block in `blocks`."""
+        return {b: i for i, b in enumerate(self.bids.tolist()) if b in blocks}
+
+
+def pan_to_paths(pan, names=None):
+    """Paths of the graph, restricted to `names` if given."""
+    paths = [p for p in pan.paths if names is None or p.name in names]
+    block_idx = {}
+    for path in paths:
+        for b in path.block_ids:
+            block_idx.setdefault(b, len(block_idx))
     res = {}
-    for path in pan.paths:
-        name = path.name
-        res[name] = Path.from_pangraph_path(path)
+    for path in paths:
+        res[path.name] = Path(
+            path.name, path.block_ids, path.block_strands, path.block_nums, block_idx
+        )
     return res
 
 
-class Glue:
-    def __init__(self, path_dict) -> None:
-        assert len(path_dict) == 2
+def core_blocks(path_dict):
+    """Blocks that occur exactly once in every path."""
+    counts = [pd.Series(p.bids).value_counts() for p in path_dict.values()]
+    once = [set(c.index[c == 1]) for c in counts]
+    return set.intersection(*once)
 
-        self.k1, self.k2 = list(path_dict.keys())
-        self.path1 = path_dict[self.k1]
-        self.path2 = path_dict[self.k2]
 
-    def remap_msu(self, old_id: int, new_id: int) -> None:
-        self.path1.remap_msu(old_id, new_id)
-        self.path2.remap_msu(old_id, new_id)
+class Glue:
+    """Extend anchor nodes (one per path) along all paths for as long as
+    the flanking edges agree in every path. Nodes are referred to by their
+    index in each path. MSUs that touch are merged with a union-find over
+    MSU ids. Every node is assigned at most once, so the cost is linear in
+    the total path length."""
 
-    def extend(self, n1: Node, n2: Node, msu_id: int) -> None:
-        vprint(f"Extending {n1} and {n2}", indent=1)
-        assert n1.bid == n2.bid
+    def __init__(self, path_dict) -> None:
+        assert len(path_dict) >= 2
+
+        self.names = list(path_dict.keys())
+        self.paths = list(path_dict.values())
+        self.parent = {0: 0}
+
+    def find(self, x):
+        root = x
+        while self.parent[root] != root:
+            root = self.parent[root]
+        # path compression
+        while self.parent[x] != root:
+            self.parent[x], x = root, self.parent[x]
+        return root
+
+    def union(self, old_id, new_id):
+        r_old, r_new = self.find(old_id), self.find(new_id)
+        if r_old != r_new:
+            self.parent[r_old] = r_new
+
+    def assign(self, idxs, msu_id):
+        signature = nodes_signature([p.node(i) for p, i in zip(self.paths, idxs)])
+        for p, i in zip(self.paths, idxs):
+            p.msu[i], p.signature[i] = msu_id, signature
+
+    def extend(self, idxs, msu_id):
+        P = self.paths
+        assert len({p.bids[i] for p, i in zip(P, idxs)}) == 1
 
         # if already assigned skip
-        if (x := self.path1.get_msu(n1)) != 0:
-            assert self.path2.get_msu(n2) == x
-            vprint(f"Already assigned {n1} and {n2} to {x}", indent=1)
+        if (x := self.find(P[0].msu[idxs[0]])) != 0:
+            assert all(self.find(p.msu[i]) == x for p, i in zip(P, idxs))
             return
 
-        # if both are unassigned, extend
-        vprint(f"Assigning msu of focal nodes {n1} and {n2} to {msu_id}", indent=1)
-        signature = hash((n1, n2))
-        self.path1.set_msu(n1, msu_id, signature)
-        self.path2.set_msu(n2, msu_id, signature)
-        c1 = self.glue_side(n1, n2, True, msu_id)
-        c2 = self.glue_side(n1, n2, False, msu_id)
+        # if all are unassigned, extend
+        self.parent[msu_id] = msu_id
+        self.assign(idxs, msu_id)
+        c1 = self.glue_side(idxs, True, msu_id)
+        c2 = self.glue_side(idxs, False, msu_id)
 
         for c in [c1, c2]:
             if c is not None:
-                self.remap_msu(c[0], c[1])
-
-    def compare(self, n1: int, n2: int, s1: bool, s2: bool) -> bool:
-        e1 = self.path1.next_edge(n1, s1)
-        e2 = self.path2.next_edge(n2, s2)
-        vprint(f"Comparing {e1} and {e2}", indent=3)
-        assert n1.bid == n2.bid, f"{n1} != {n2}"
-        vprint(f"Result {e1 == e2}", indent=3)
-        return e1 == e2
-
-    def glue_side(self, n1: Node, n2: Node, fwd: bool, msu_id: int):
-        vprint(f"Gluing side {fwd} of {n1} and {n2}", indent=2)
-
-        s1 = n1.strand if fwd else not n1.strand
-        s2 = n2.strand if fwd else not n2.strand
+                self.union(c[0], c[1])
 
-        vprint(f"Focal nodes {n1} and {n2}", indent=2)
+    def glue_side(self, idxs, fwd, msu_id):
+        P = self.paths
+        # direction of the walk along each path
+        dirs = [bool(p.strands[i]) == fwd for p, i in zip(P, idxs)]
 
-        while self.compare(n1, n2, s1, s2):
+        while len({p.next_edge(i, d) for p, i, d in zip(P, idxs, dirs)}) == 1:
             # next nodes
-            nn1 = self.path1.next_node(n1, s1)
-            nn2 = self.path2.next_node(n2, s2)
-            vprint(f"Next nodes {nn1} and {nn2}", indent=3)
+            nxt = [p.next_idx(i, d) for p, i, d in zip(P, idxs, dirs)]
             # if already assigned, skip
-            old_1 = self.path1.get_msu(nn1)
-            old_2 = self.path2.get_msu(nn2)
-            if old_1 != 0 or old_2 != 0:
-                vprint(
-                    f"## Already assigned {nn1} -> {old_1} or {nn2} -> {old_2}",
-                    indent=3,
-                )
-                if old_1 == old_2:
-                    vprint(f"## Reassigning {old_1} -> {msu_id}", indent=3)
-                    return (old_1, msu_id)
+            olds = [self.find(p.msu[i]) for p, i in zip(P, nxt)]
+            if any(olds):
+                if len(set(olds)) == 1:
+                    return (olds[0], msu_id)
                 else:
                     return None
-            vprint(f"Assigning {nn1} and {nn2} to {msu_id}", indent=3)
-            signature = hash((nn1, nn2))
-            self.path1.set_msu(nn1, msu_id, signature)
-            self.path2.set_msu(nn2, msu_id, signature)
-            n1, n2 = nn1, nn2
-
-    def to_df(self) -> pd.DataFrame:
-
-        df1 = self.path1.to_df()
-        df1["path"] = self.k1
-        df2 = self.path2.to_df()
-        df2["path"] = self.k2
-        df = pd.concat([df1, df2], axis=0)
-
-        # remap msus:
-        msus = sorted(set(df["msu"]) | {0})
-        msu_map = {msu: i for i, msu in enumerate(msus)}
-        msu_map[0] == None
+            self.assign(nxt, msu_id)
+            idxs = nxt
+
+    def project(self, path):
+        """Assign the nodes of a `path` that was not glued to the MSUs of the
+        first glued path. Anchors are blocks present once in both paths and
+        in a MSU, and they are extended as long as the two paths agree and
+        remain in the same MSU. Projected nodes take the signature of the
+        node of the first path that they correspond to."""
+        ref = self.paths[0]
+        once = core_blocks({0: ref, 1: path})
+        ref_idx, path_idx = ref.index(once), path.index(once)
+        for b in sorted(once, key=ref_idx.get):
+            i, j = ref_idx[b], path_idx[b]
+            m = self.find(ref.msu[i])
+            if m == 0 or path.msu[j] != 0:
+                continue
+            path.msu[j], path.signature[j] = m, ref.signature[i]
+            for fwd in [True, False]:
+                self.project_side(path, i, j, fwd, m)
+
+    def project_side(self, path, i, j, fwd, msu_id):
+        ref = self.paths[0]
+        di = bool(ref.strands[i]) == fwd
+        dj = bool(path.strands[j]) == fwd
+        while ref.next_edge(i, di) == path.next_edge(j, dj):
+            i, j = ref.next_idx(i, di), path.next_idx(j, dj)
+            if path.msu[j] != 0 or self.find(ref.msu[i]) != msu_id:
+                return
+            path.msu[j], path.signature[j] = msu_id, ref.signature[i]
+
+    def path_df(self, path):
+        return pd.DataFrame(
+            {
+                "bid": path.bids,
+                "strand": path.strands,
+                "occ": path.occs,
+                "msu": [self.find(x) for x in path.msu],
+                "signature": path.signature,
+                "path": path.name,
+            }
+        )
+
+    def to_df(self, paths=None) -> pd.DataFrame:
+        """Table of the nodes of `paths` (by default the glued paths), which
+        can include projected paths."""
+        if paths is None:
+            paths = self.paths
+        df = pd.concat([self.path_df(p) for p in paths], axis=0)
+
+        # renumber msus 1, 2, ... in order of first appearance along the
+        # first glued path, keeping 0 for unassigned nodes
+        m1 = self.path_df(self.paths[0])["msu"].to_numpy()
+        first = pd.unique(m1[m1 != 0])
+        msu_map = {m: i + 1 for i, m in enumerate(first)}
+        msu_map[0] = 0
         df["msu"] = df["msu"].map(msu_map)
         return df
@@ -0,0 +1,580 @@
+import numpy as np
+import pandas as pd
+import hashlib
+import json
+import os
+import pathlib
+import argparse
+import tempfile
+import re
+
+CACHE_VERSION = 3
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--graph", type=str, help="Pangraph JSON file", required=True)
+    parser.add_argument("--out", type=str, help="Output cache (.npz) file", required=True)
+    return parser.parse_args()
+
+
+def default_cache_file(graph_file):
+    # graph.json -> graph.npz, in the same folder
+    return pathlib.Path(graph_file).with_suffix(".npz")
+
+
+def file_digest(fname):
+    h = hashlib.sha1()
+    with open(fname, "rb") as f:
+        while chunk := f.read(1 << 24):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def source_signature(graph_file):
+    st = os.stat(graph_file)
+    return {"size": st.st_size, "mtime_ns": st.st_mtime_ns}
+
+
+def node_key(node):
+    return (node["name"], node["number"], node["strand"])
+
+
+def block_length(block):
+    # stripped blocks from the streaming loader only keep the length
+    if "length" in block:
+        return block["length"]
+    return len(block["sequence"])
+
+
+def block_digest(block):
+    """Hash of the alignment data of a block (consensus, gaps, mutations and
+    indels of every occurrence). It changes whenever the reconstructed
+    alignment would change, irrespective of the block id. Empty for the
+    stripped blocks of the streaming loader."""
+    if "sequence" not in block:
+        return ""
+    data = [
+        block["sequence"],
+        block.get("gaps", {}),
+        block["mutate"],
+        block["insert"],
+        block["delete"],
+    ]
+    return hashlib.sha1(json.dumps(data).encode()).hexdigest()
+
+
+# ---------------- cache creation ----------------
+
+
+def graph_to_arrays(pan_json):
+    """Convert the raw pangraph json dictionary into a dictionary of flat
+    numpy arrays. Occurrences are indexed by (block, occurrence) and
+    mutations/indels refer to them through the `*_occ` arrays."""
+
+    block_ids = [b["id"] for b in pan_json["blocks"]]
+    block_idx = {bid: i for i, bid in enumerate(block_ids)}
+    block_len = [block_length(b) for b in pan_json["blocks"]]
+    block_dig = [block_digest(b) for b in pan_json["blocks"]]
+
+    path_names = [p["name"] for p in pan_json["paths"]]
+    path_idx = {name: i for i, name in enumerate(path_names)}
+    path_offsets, path_pos_offsets = [0], [0]
+    path_block, path_strand, path_num, path_pos, path_circ = [], [], [], [], []
+    for p in pan_json["paths"]:
+        path_block += [block_idx[n["id"]] for n in p["blocks"]]
+        path_strand += [n["strand"] for n in p["blocks"]]
+        path_num += [n["number"] for n in p["blocks"]]
+        path_pos += list(p["position"])
+        path_circ.append(p.get("circular", True))
+        path_offsets.append(len(path_block))
+        path_pos_offsets.append(len(path_pos))
+
+    occ_block, occ_path, occ_num, occ_strand = [], [], [], []
+    block_occ_offsets = [0]
+    muts = {"occ": [], "pos": [], "alt": []}
+    ins = {"occ": [], "pos": [], "start": [], "len": [], "seq": []}
+    dels = {"occ": [], "pos": [], "len": []}
+    for bi, b in enumerate(pan_json["blocks"]):
+        occ_ids = {}
+        for node, ms in b["mutate"]:
+            k = node_key(node)
+            occ_ids[k] = len(occ_block)
+            occ_block.append(bi)
+            occ_path.append(path_idx[k[0]])
+            occ_num.append(k[1])
+            occ_strand.append(k[2])
+            for pos, alt in ms:
+                muts["occ"].append(occ_ids[k])
+                muts["pos"].append(pos)
+                muts["alt"].append(alt)
+        block_occ_offsets.append(len(occ_block))
+
+        for node, ii in b["insert"]:
+            oi = occ_ids[node_key(node)]
+            for (pos, ins_start), seq in ii:
+                ins["occ"].append(oi)
+                ins["pos"].append(pos)
+                ins["start"].append(ins_start)
+                ins["len"].append(len(seq))
+                ins["seq"].append(seq)
+
+        for node, ds in b["delete"]:
+            oi = occ_ids[node_key(node)]
+            for d_start, d_len in ds:
+                dels["occ"].append(oi)
+                dels["pos"].append(d_start)
+                dels["len"].append(d_len)
+
+    # insertions and deletions are listed per block in their own order:
+    # sort them by occurrence, as mutations already are
+    for d in [ins, dels]:
+        order = sorted(range(len(d["occ"])), key=d["occ"].__getitem__)
+        for k in d:
+            d[k] = [d[k][j] for j in order]
+    ins_seq = "".join(ins["seq"]).encode()
+    return {
+        "block_ids": np.array(block_ids, dtype=str),
+        "block_len": np.array(block_len, dtype=np.int64),
+        "block_digest": np.array(block_dig, dtype=str),
+        "path_names": np.array(path_names, dtype=str),
+        "path_circular": np.array(path_circ, dtype=bool),
+        "path_offsets": np.array(path_offsets, dtype=np.int64),
+        "path_block": np.array(path_block, dtype=np.int32),
+        "path_strand": np.array(path_strand, dtype=bool),
+        "path_num": np.array(path_num, dtype=np.int32),
+        "path_pos_offsets": np.array(path_pos_offsets, dtype=np.int64),
+        "path_pos": np.array(path_pos, dtype=np.int64),
+        "block_occ_offsets": np.array(block_occ_offsets, dtype=np.int64),
+        "occ_block": np.array(occ_block, dtype=np.int32),
+        "occ_path": np.array(occ_path, dtype=np.int32),
+        "occ_num": np.array(occ_num, dtype=np.int32),
+        "occ_strand": np.array(occ_strand, dtype=bool),
+        "mut_occ": np.array(muts["occ"], dtype=np.int32),
+        "mut_pos": np.array(muts["pos"], dtype=np.int64),
+        "mut_alt": np.array(muts["alt"], dtype="S1"),
+        "ins_occ": np.array(ins["occ"], dtype=np.int32),
+        "ins_pos": np.array(ins["pos"], dtype=np.int64),
+        "ins_start": np.array(ins["start"], dtype=np.int64),
+        "ins_len": np.array(ins["len"], dtype=np.int64),
+        "ins_seq": np.frombuffer(ins_seq, dtype=np.uint8),
+        "del_occ": np.array(dels["occ"], dtype=np.int32),
+        "del_pos": np.array(dels["pos"], dtype=np.int64),
+        "del_len": np.array(dels["len"], dtype=np.int64),
+    }
+
+
+def build_cache(graph_file, cache_file):
+    with open(graph_file, "r") as f:
+        pan_json = json.load(f)
+    arrays = graph_to_arrays(pan_json)
+    meta = {
+        "version": CACHE_VERSION,
+        "digest": file_digest(graph_file),
+        **source_signature(graph_file),
+    }
+    arrays["meta"] = np.array(json.dumps(meta))
+    # write to a temporary file first, so that an interrupted run never
+    # leaves a truncated cache behind. The name is unique, so that
+    # concurrent builds do not write to the same file
+    cache_file = pathlib.Path(cache_file)
+    with tempfile.NamedTemporaryFile(
+        dir=cache_file.parent, prefix=cache_file.name, suffix=".tmp", delete=False
+    ) as f:
+        tmp_file = f.name
+    try:
+        with open(tmp_file, "wb") as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_file, cache_file)
+    except BaseException:
+        os.unlink(tmp_file)
+        raise
+
+
+def is_fresh(meta, graph_file):
+    if meta.get("version") != CACHE_VERSION:
+        return False
+    sig = source_signature(graph_file)
+    if sig["size"] != meta["size"]:
+        return False
+    if sig["mtime_ns"] == meta["mtime_ns"]:
+        return True
+    # file was touched or copied: fall back on the content digest
+    return file_digest(graph_file) == meta["digest"]
+
+
+def ensure_cache(graph_file, cache_file=None):
+    """Build the cache unless an up to date one is already present."""
+    if cache_file is None:
+        cache_file = default_cache_file(graph_file)
+    if os.path.exists(cache_file):
+        meta, _ = load_cache(cache_file)
+        if is_fresh(meta, graph_file):
+            return cache_file
+    build_cache(graph_file, cache_file)
+    return cache_file
+
+
+# ---------------- cached graph objects ----------------
+
+
+class CachedPath:
+    def __init__(self, name, block_ids, block_strands, block_nums, positions, circ):
+        self.name = name
+        self.block_ids = block_ids
+        self.block_strands = block_strands
+        self.block_nums = block_nums
+        self.block_positions = positions
+        self.circular = circ
+
+    def __len__(self):
+        return len(self.block_ids)
+
+
+class CachedPaths:
+    def __init__(self, paths):
+        self.paths = paths
+        self.idx = {p.name: i for i, p in enumerate(paths)}
+
+    def __iter__(self):
+        return iter(self.paths)
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __getitem__(self, name):
+        return self.paths[self.idx[name]]
+
+    def __contains__(self, name):
+        return name in self.idx
+
+
+class CachedAlignment:
+    """Mutations and indels of one block, with the same dictionary layout as
+    the pypangraph alignment: keys are (iso, num, strand) occurrences."""
+
+    def __init__(self, occs, muts, ins, dels):
+        self.occs = occs
+        self.muts = muts
+        self.ins = ins
+        self.dels = dels
+
+
+class CachedBlock:
+    def __init__(self, graph, i):
+        self.graph = graph
+        self.i = i
+        self.id = graph.arrays["block_ids"][i]
+        self.length = int(graph.arrays["block_len"][i])
+        self._alignment = None
+
+    def __len__(self):
+        return self.length
+
+    @property
+    def alignment(self):
+        if self.graph.full_blocks is not None:
+            raise ValueError(
+                f"alignment of block {self.id} was not loaded: the graph was "
+                f"stream-loaded with blocks={self.graph.selection}, which does "
+                "not include it. Pass the block in the `blocks` of load_graph."
+            )
+        if self._alignment is None:
+            self._alignment = self.graph.block_alignment(self.i)
+        return self._alignment
+
+
+class CachedBlocks:
+    def __init__(self, graph):
+        self.graph = graph
+        self.idx = {bid: i for i, bid in enumerate(graph.arrays["block_ids"])}
+        self.blocks = {}
+
+    def __getitem__(self, bid):
+        full_blocks = self.graph.full_blocks
+        if (full_blocks is not None) and (bid in full_blocks):
+            return full_blocks[bid]
+        if bid not in self.blocks:
+            self.blocks[bid] = CachedBlock(self.graph, self.idx[bid])
+        return self.blocks[bid]
+
+    def __iter__(self):
+        return (self[bid] for bid in self.idx)
+
+    def __len__(self):
+        return len(self.idx)
+
+    def __contains__(self, bid):
+        return bid in self.idx
+
+
+class CachedGraph:
+    """Read-only graph backed by the arrays of the binary cache. Exposes the
+    subset of the pypangraph interface used by the pipeline scripts:
+    `paths`, `blocks[bid].alignment`, `strains()` and `to_blockstats_df()`.
+    Graphs from the streaming loader carry alignment data only for the
+    pypangraph blocks in `full_blocks`, and `selection` describes the
+    `blocks` passed to the loader."""
+
+    def __init__(self, arrays, full_blocks=None, selection=None):
+        self.arrays = arrays
+        self.full_blocks = full_blocks
+        self.selection = selection
+        A = arrays
+        bids = A["block_ids"]
+        paths = []
+        for i, name in enumerate(A["path_names"]):
+            s, e = A["path_offsets"][i], A["path_offsets"][i + 1]
+            ps, pe = A["path_pos_offsets"][i], A["path_pos_offsets"][i + 1]
+            path = CachedPath(
+                str(name),
+                bids[A["path_block"][s:e]],
+                A["path_strand"][s:e],
+                A["path_num"][s:e],
+                A["path_pos"][ps:pe],
+                bool(A["path_circular"][i]),
+            )
+            paths.append(path)
+        self.paths = CachedPaths(paths)
+        self.blocks = CachedBlocks(self)
+        self._indexes = None
+
+    def strains(self):
+        return [p.name for p in self.paths]
+
+    def block_digests(self):
+        # graphs from the streaming loader have no digests
+        A = self.arrays
+        return {
+            b: d
+            for b, d in zip(A["block_ids"].tolist(), A["block_digest"].tolist())
+            if d
+        }
+
+    def occ_keys(self, occ_idxs):
+        A = self.arrays
+        names = A["path_names"]
+        P, N, S = A["occ_path"], A["occ_num"], A["occ_strand"]
+        return [(str(names[P[o]]), int(N[o]), bool(S[o])) for o in occ_idxs]
+
+    def _sorted_index(self, occ_array):
+        # mutations are grouped by occurrence, and occurrences by block:
+        # boundaries of each occurrence in the (sorted) arrays
+        n_occ = len(self.arrays["occ_block"])
+        return np.searchsorted(occ_array, np.arange(n_occ + 1))
+
+    def block_alignment(self, i):
+        A = self.arrays
+        if self._indexes is None:
+            self._indexes = {
+                k: self._sorted_index(A[f"{k}_occ"]) for k in ["mut", "ins", "del"]
+            }
+            self._indexes["ins_seq_end"] = np.cumsum(A["ins_len"])
+        mi, ii, di = (self._indexes[k] for k in ["mut", "ins", "del"])
+        ins_seq_end = self._indexes["ins_seq_end"]
+
+        o0, o1 = A["block_occ_offsets"][i], A["block_occ_offsets"][i + 1]
+        occs = self.occ_keys(range(o0, o1))
+        muts, ins, dels = {}, {}, {}
+        for o, k in zip(range(o0, o1), occs):
+            muts[k] = [
+                (int(A["mut_pos"][j]), A["mut_alt"][j].decode())
+                for j in range(mi[o], mi[o + 1])
+            ]
+            ins[k] = []
+            for j in range(ii[o], ii[o + 1]):
+                e = ins_seq_end[j]
+                seq = A["ins_seq"][e - A["ins_len"][j] : e].tobytes().decode()
+                ins[k].append(((int(A["ins_pos"][j]), int(A["ins_start"][j])), seq))
+            dels[k] = [
+                (int(A["del_pos"][j]), int(A["del_len"][j]))
+                for j in range(di[o], di[o + 1])
+            ]
+        return CachedAlignment(occs, muts, ins, dels)
+
+    def to_blockstats_df(self):
+        A = self.arrays
+        n_blocks = len(A["block_ids"])
+        count = np.bincount(A["occ_block"], minlength=n_blocks)
+        # number of distinct paths in which each block appears
+        pairs = np.unique(np.stack([A["occ_block"], A["occ_path"]]), axis=1)
+        n_strains = np.bincount(pairs[0], minlength=n_blocks)
+        df = pd.DataFrame(
+            {
+                "count": count,
+                "n. strains": n_strains,
+                "len": A["block_len"],
+                "duplicated": count > n_strains,
+            },
+            index=A["block_ids"],
+        )
+        df["core"] = (df["n. strains"] == len(self.paths)) & (~df["duplicated"])
+        # blocks in order of first appearance along the paths, as in
+        # pypangraph, so that the outputs do not depend on the loader
+        order = pd.unique(np.concatenate([A["path_block"], np.arange(n_blocks)]))
+        return df.iloc[order]
+
+
+def load_cache(cache_file):
+    with np.load(cache_file) as data:
+        arrays = {k: data[k] for k in data.files}
+    meta = json.loads(str(arrays.pop("meta")))
+    return meta, arrays
+
+
+# ---------------- streaming json loader ----------------
+
+_WS = re.compile(r"[ \t\n\r]*")
+
+
+class JSONStream:
+    """Minimal incremental reader for a json file, that decodes one value
+    at a time with the standard library decoder. Used to go through the
+    elements of the top-level `paths` and `blocks` arrays without holding
+    the whole parsed graph in memory."""
+
+    def __init__(self, f, chunk_size=1 << 22):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buf, self.pos, self.eof = "", 0, False
+        self.decoder = json.JSONDecoder()
+
+    def fill(self):
+        # read at least as much as is already buffered, so that values
+        # larger than a chunk are re-scanned only a logarithmic number of times
+        data = self.f.read(max(self.chunk_size, len(self.buf) - self.pos))
+        self.eof = len(data) == 0
+        self.buf = self.buf[self.pos :] + data
+        self.pos = 0
+
+    def peek(self):
+        while True:
+            self.pos = _WS.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if self.eof:
+                return ""
+            self.fill()
+
+    def expect(self, char):
+        c = self.peek()
+        if c != char:
+            raise ValueError(f"expected {char!r} but found {c!r} in json stream")
+        self.pos += 1
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                obj, end = self.decoder.raw_decode(self.buf, self.pos)
+                # a number at the end of the buffer could be truncated
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return obj
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self.fill()
+
+    def items(self):
+        """Iterate over (key, value) of the top-level object. Values of
+        arrays are yielded one element at a time as (key, element)."""
+        self.expect("{")
+        while self.peek() != "}":
+            key = self.value()
+            self.expect(":")
+            if self.peek() == "[":
+                self.pos += 1
+                while self.peek() != "]":
+                    yield key, self.value()
+                    if self.peek() == ",":
+                        self.pos += 1
+                self.pos += 1
+            else:
+                yield key, self.value()
+            if self.peek() == ",":
+                self.pos += 1
+        self.pos += 1
+
+
+def strip_block(block):
+    """Drop consensus, mutations and indels, keeping only the length and
+    the list of occurrences of the block."""
+    return {
+        "id": block["id"],
+        "length": len(block["sequence"]),
+        "mutate": [[node, []] for node, _ in block["mutate"]],
+        "insert": [],
+        "delete": [],
+    }
+
+
+def is_core(block, n_paths):
+    isos = [node["name"] for node, _ in block["mutate"]]
+    return len(isos) == n_paths and len(set(isos)) == n_paths
+
+
+def load_graph_lazy(graph_file, blocks=()):
+    """Stream-parse the pangraph json. Full pypangraph blocks (with
+    alignments) are created only for `blocks`, which is either a collection
+    of block ids or the string "core". All other blocks are reduced to
+    their length and occurrences as soon as they are parsed."""
+    import pypangraph as pp
+
+    paths, stripped, kept = [], [], []
+    with open(graph_file, "r") as f:
+        for key, item in JSONStream(f).items():
+            if key == "paths":
+                paths.append(item)
+            elif key == "blocks":
+                if blocks == "core":
+                    # if paths come after blocks in the file the number of
+                    # paths is unknown: keep the block to be safe
+                    keep = (not paths) or is_core(item, len(paths))
+                else:
+                    keep = item["id"] in blocks
+                if keep:
+                    kept.append(item)
+                stripped.append(strip_block(item))
+
+    if blocks == "core":
+        kept = [b for b in kept if is_core(b, len(paths))]
+    arrays = graph_to_arrays({"paths": paths, "blocks": stripped})
+    full = pp.Pangraph({"paths": paths, "blocks": kept})
+    full_blocks = {b["id"]: full.blocks[b["id"]] for b in kept}
+    selection = repr(blocks) if blocks == "core" else f"<{len(blocks)} block ids>"
+    return CachedGraph(arrays, full_blocks=full_blocks, selection=selection)
+
+
+def load_graph(graph_file, cache_file=None, alignments=False, blocks=None):
+    """Load the graph for a pipeline stage.
+
+    - `alignments`: whether the stage reconstructs alignments, which needs
+      the consensus sequences not stored in the cache.
+    - `blocks`: ids of the blocks whose alignment data (mutations, indels
+      and, with `alignments`, sequences) is needed, or "core", or None for
+      all blocks. An empty tuple is for topology-only stages.
+
+    Without `alignments` the binary cache is used when present and up to
+    date. Otherwise, if `blocks` is given the json is stream-parsed
+    keeping alignment data only for those blocks, and if it is None the
+    whole graph is loaded with the pypangraph json loader."""
+    if not alignments:
+        if cache_file is None:
+            cache_file = default_cache_file(graph_file)
+        if os.path.exists(cache_file):
+            meta, arrays = load_cache(cache_file)
+            if is_fresh(meta, graph_file):
+                return CachedGraph(arrays)
+
+    if blocks is not None:
+        return load_graph_lazy(graph_file, blocks)
+
+    import pypangraph as pp
+
+    return pp.Pangraph.load_json(graph_file)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    build_cache(args.graph, args.out)
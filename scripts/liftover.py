@@ -0,0 +1,425 @@
+import numpy as np
+import pandas as pd
+import graph_cache as gc
+import mutations_positions as mp
+import table_io as tio
+import argparse
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Lift positions or intervals from one genome of a comparison to the other"
+    )
+    parser.add_argument("--graph", type=str, help="Pangraph JSON file", required=True)
+    parser.add_argument(
+        "--seq_lengths", type=str, help="Sequence lengths CSV file", required=True
+    )
+    parser.add_argument(
+        "--block_positions", type=str, help="Block positions CSV file", required=True
+    )
+    parser.add_argument(
+        "--msu",
+        type=str,
+        help="Minimal synteny units CSV file, used to resolve duplicated blocks",
+    )
+    parser.add_argument("--source", type=str, help="Source genome", required=True)
+    parser.add_argument("--target", type=str, help="Target genome", required=True)
+    parser.add_argument("--input", type=str, help="Input BED file, or CSV file")
+    parser.add_argument("--output", type=str, help="Output file")
+    parser.add_argument(
+        "--unmapped", type=str, help="Output file for records that could not be lifted"
+    )
+    parser.add_argument(
+        "--format",
+        type=str,
+        choices=["bed", "csv"],
+        default="bed",
+        help="bed: lift intervals. csv: lift the positions in the `pos` column",
+    )
+    parser.add_argument("--chunksize", type=int, default=1_000_000)
+    parser.add_argument(
+        "--check",
+        type=int,
+        metavar="N",
+        help="Instead of lifting the input, lift N random positions and compare "
+        "them with the alignment columns of the reconstructed blocks",
+    )
+    args = parser.parse_args()
+    if args.check is None and (args.input is None or args.output is None):
+        parser.error("--input and --output are required unless --check is given")
+    return args
+
+
+class Liftover:
+    """Map positions between the two genomes of a comparison through the
+    block occurrences they belong to.
+
+    A source position is converted into a position on the block consensus
+    (removing the indels of the source occurrence) and then projected on
+    every occurrence of the same block in the target genome. Positions in
+    the genomes and along the occurrences and the consensus are 0-based,
+    while indels use the 1-based positions of pangraph. For blocks in
+    a minimal synteny unit only the syntenic target occurrence is kept,
+    otherwise all occurrences are reported as duplicated hits."""
+
+    def __init__(self, pan, Ls, P, msu=None):
+        bids = pd.unique(P.index.get_level_values("block_id"))
+        self.occ = mp.OccurrenceIndex(pan, bids, Ls, P)
+        O = self.occ
+        self.occ_block = np.repeat(
+            np.arange(len(O.bids)), np.diff(O.block_occ_offsets)
+        )
+        lens = pan.to_blockstats_df()["len"]
+        self.cons_len = lens.reindex(O.occ_bids).to_numpy(dtype=np.int64)
+        # keys occ * K + position, with K larger than any consensus or
+        # sequence position
+        self.K = int(self.cons_len.max(initial=0)) + 2
+        self.K2 = int(O.L.max(initial=0)) + 2
+        self.segments = self.consensus_segments()
+        self.seq_segments = self.sequence_segments()
+
+        n = len(O.isos)
+        self.msu = np.zeros(n, dtype=np.int64)
+        self.signature = np.zeros(n, dtype=np.int64)
+        if msu is not None:
+            idx = pd.MultiIndex.from_arrays([O.isos, O.occ_bids, O.nums])
+            M = msu.set_index(["path", "bid", "occ"]).reindex(idx)
+            self.msu = M["msu"].fillna(0).to_numpy(dtype=np.int64)
+            self.signature = M["signature"].fillna(0).to_numpy(dtype=np.int64)
+
+    # ---------------- sequence <-> consensus ----------------
+
+    def indels(self, indels):
+        # occurrence, 1-based position and length of each indel
+        keys, cum, _ = indels
+        return keys // self.occ.K, keys % self.occ.K, np.diff(cum)
+
+    def consensus_segments(self):
+        """For every occurrence, segments of consensus positions (0-based)
+        with a constant offset between sequence and consensus positions.
+        Segments start at 0, at each insertion (gap g holds the insertions
+        after 1-based position g, i.e. before 0-based position g), at the
+        first and past the last position of each deletion (1-based
+        [d, d + n - 1]) and at the end of the consensus. Returns the keys
+        occ * K + first position, the offset and whether the positions of
+        the segment are present in the occurrence, sorted by key."""
+        O = self.occ
+        n = len(O.isos)
+        i_occ, i_pos, i_len = self.indels(O.ins)
+        d_occ, d_pos, d_len = self.indels(O.dels)
+        zero = np.zeros(n, dtype=np.int64)
+        zi, zd = np.zeros_like(i_occ), np.zeros_like(d_occ)
+
+        occ = np.concatenate([np.arange(n), i_occ, d_occ, d_occ, np.arange(n)])
+        pos = np.concatenate([zero, i_pos, d_pos - 1, d_pos - 1 + d_len, self.cons_len])
+        shift = np.concatenate([zero, i_len, zd, -d_len, zero])
+        # +1 when entering a deletion or past the end of the consensus
+        absent = np.concatenate([zero, zi, zd + 1, zd - 1, zero + 1])
+
+        keys = occ * self.K + pos
+        order = np.argsort(keys, kind="stable")
+        keys, occ = keys[order], occ[order]
+        offset, absent = np.cumsum(shift[order]), np.cumsum(absent[order])
+        # the first entry of each occurrence is the segment at 0, which
+        # carries no shift: cumulative sums restart from it
+        first = np.searchsorted(keys, np.arange(n) * self.K)
+        offset -= offset[first][occ]
+        absent -= absent[first][occ]
+
+        # with several breakpoints at the same position keep the last
+        keep = np.append(keys[1:] != keys[:-1], True)
+        return keys[keep], offset[keep], absent[keep] == 0
+
+    def sequence_segments(self):
+        """The segments present in their occurrence, keyed by occ * K2 +
+        first sequence position, with their last sequence position.
+        Sequence positions between segments are in insertions."""
+        keys, offset, present = self.segments
+        K = self.K
+        occ, pos = keys // K, keys % K
+        # every present segment is followed by another one of the same
+        # occurrence, at least the one at the end of the consensus
+        seq_start = pos + offset
+        seq_last = np.append(pos[1:], 0) - 1 + offset
+        p = np.flatnonzero(present)
+        return occ[p] * self.K2 + seq_start[p], seq_last[p], offset[p]
+
+    def to_consensus(self, occ, seq_pos):
+        """Consensus positions (0-based) of sequence positions (0-based) on
+        the given occurrences. Positions in insertions, that have no
+        consensus position, are -1."""
+        keys, seq_last, offset = self.seq_segments
+        q = occ * self.K2 + seq_pos
+        j = np.searchsorted(keys, q, side="right") - 1
+        jc = np.maximum(j, 0)
+        ok = (j >= 0) & (keys[jc] // self.K2 == occ) & (seq_pos <= seq_last[jc])
+        return np.where(ok, seq_pos - offset[jc], -1)
+
+    def to_sequence(self, occ, cons_pos):
+        """Sequence positions (0-based) of consensus positions (0-based) on
+        the given occurrences, or -1 if they are deleted."""
+        keys, offset, present = self.segments
+        j = np.searchsorted(keys, occ * self.K + cons_pos, side="right") - 1
+        return np.where(present[j], cons_pos + offset[j], -1)
+
+    # ---------------- locate positions ----------------
+
+    def locate(self, genome, pos):
+        """Occurrence of `genome` containing each position, and the position
+        along the occurrence sequence (0-based, in the consensus direction)."""
+        O = self.occ
+        g_occ = np.nonzero(O.isos == genome)[0]
+        g_occ = g_occ[np.argsort(O.start[g_occ], kind="stable")]
+        L = O.L[g_occ[0]]
+        pos = np.asarray(pos, dtype=np.int64) % L
+        # blocks tile the genome: the block with the largest start also
+        # covers the positions before the first start (circular wrap)
+        i = np.searchsorted(O.start[g_occ], pos, side="right") - 1
+        occ = g_occ[i % len(g_occ)]
+        fwd = (pos - O.start[occ]) % L
+        rev = (O.end[occ] - 1 - pos) % L
+        return occ, np.where(O.strand[occ], fwd, rev)
+
+    def genome_positions(self, occ, seq_pos):
+        # inverse of `locate`
+        O = self.occ
+        L = O.L[occ]
+        fwd = (O.start[occ] + seq_pos) % L
+        rev = (O.end[occ] - 1 - seq_pos) % L
+        return np.where(O.strand[occ], fwd, rev)
+
+    # ---------------- liftover ----------------
+
+    def targets(self, src_occ, target):
+        """All (row, target occurrence) candidate pairs. For source
+        occurrences in an MSU only the occurrence with the same signature
+        is a candidate. Returns the index of the source occurrence in
+        `src_occ` and the target occurrence of each pair."""
+        O = self.occ
+        t_occ = np.nonzero(O.isos == target)[0]
+        nb = len(O.bids)
+        counts = np.bincount(self.occ_block[t_occ], minlength=nb)
+        t_first = np.concatenate([[0], np.cumsum(counts)])
+
+        b = self.occ_block[src_occ]
+        n = counts[b]
+        row = np.repeat(np.arange(len(src_occ)), n)
+        rank = np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n)
+        cand = t_occ[np.repeat(t_first[b], n) + rank]
+
+        in_msu = self.msu[src_occ[row]] != 0
+        syntenic = self.signature[cand] == self.signature[src_occ[row]]
+        keep = (~in_msu) | syntenic
+        return row[keep], cand[keep]
+
+    def lift_points(self, source, target, pos):
+        """Lift positions from the source to the target genome. Returns a
+        dataframe with one row per hit: `idx` (index of the query position),
+        target `pos`, relative `strand` ("+" or "-"), `n_hits` and
+        `status`, that is "ok", "duplicated" or "unmapped"."""
+        O = self.occ
+        pos = np.asarray(pos, dtype=np.int64)
+        src_occ, seq_pos = self.locate(source, pos)
+        cons_pos = self.to_consensus(src_occ, seq_pos)
+
+        row, cand = self.targets(src_occ, target)
+        t_seq = self.to_sequence(cand, np.maximum(cons_pos[row], 0))
+        ok = (cons_pos[row] >= 0) & (t_seq >= 0)
+        row, cand, t_seq = row[ok], cand[ok], t_seq[ok]
+        n_hits = np.bincount(row, minlength=len(pos))
+
+        t_pos = self.genome_positions(cand, t_seq)
+        strand = np.where(O.strand[src_occ[row]] == O.strand[cand], "+", "-")
+        hits = pd.DataFrame(
+            {
+                "idx": row,
+                "pos": t_pos,
+                "strand": strand,
+                "n_hits": n_hits[row],
+                "status": np.where(n_hits[row] > 1, "duplicated", "ok"),
+                "msu": self.msu[cand],
+                "target_occ": cand,
+            }
+        )
+        missing = np.nonzero(n_hits == 0)[0]
+        unmapped = pd.DataFrame(
+            {
+                "idx": missing,
+                "pos": -1,
+                "strand": ".",
+                "n_hits": 0,
+                "status": "unmapped",
+                "msu": 0,
+                "target_occ": -1,
+            }
+        )
+        res = pd.concat([hits, unmapped], ignore_index=True)
+        return res.sort_values("idx", kind="stable").reset_index(drop=True)
+
+    def lift_intervals(self, source, target, starts, ends):
+        """Lift half-open intervals [start, end). Both extremes must map to
+        a single hit, with the same relative strand and either on the same
+        target occurrence or in the same MSU. Returns the target start,
+        end and strand of each interval, and its status ("ok" or the reason
+        of failure). Target intervals that cross the origin have end < start."""
+        starts = np.asarray(starts, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+        n = len(starts)
+        pts = self.lift_points(source, target, np.concatenate([starts, ends - 1]))
+        cnt = pts["idx"].value_counts().reindex(np.arange(2 * n), fill_value=0)
+        pts = pts.drop_duplicates("idx", keep=False)
+        first = pts.set_index("idx").reindex(np.arange(2 * n))
+        s, e = first.iloc[:n], first.iloc[n:]
+
+        status = np.full(n, "ok", dtype=object)
+        dupl = (cnt.to_numpy()[:n] > 1) | (cnt.to_numpy()[n:] > 1)
+        mapped = s["status"].eq("ok").to_numpy() & e["status"].eq("ok").to_numpy()
+        same_strand = s["strand"].to_numpy() == e["strand"].to_numpy()
+        same_chain = (s["target_occ"].to_numpy() == e["target_occ"].to_numpy()) | (
+            (s["msu"].to_numpy() == e["msu"].to_numpy()) & (s["msu"].to_numpy() != 0)
+        )
+        status[~(same_chain & same_strand)] = "split"
+        status[~mapped] = "unmapped"
+        status[dupl] = "duplicated"
+
+        sp = s["pos"].fillna(-1).to_numpy(dtype=np.int64)
+        ep = e["pos"].fillna(-1).to_numpy(dtype=np.int64)
+        fwd = s["strand"].to_numpy() == "+"
+        t_start = np.where(fwd, sp, ep)
+        t_end = np.where(fwd, ep, sp) + 1
+        strand = np.where(fwd, "+", "-")
+        ok = status == "ok"
+        t_start[~ok], t_end[~ok], strand[~ok] = -1, -1, "."
+        return pd.DataFrame(
+            {"start": t_start, "end": t_end, "strand": strand, "status": status}
+        )
+
+
+def consensus_columns(L, gaps):
+    # mask of the consensus columns of a reconstructed block alignment,
+    # where gap g holds the insertions after 1-based consensus position g
+    width = np.ones(L + 1, dtype=np.int64)
+    width[0] = 0
+    for g, n in gaps.items():
+        width[int(g)] += n
+    ends = np.cumsum(width)
+    mask = np.zeros(ends[-1], dtype=bool)
+    mask[ends[:-1]] = True
+    return mask
+
+
+def check_columns(lo, pan, source, target, n=10000, seed=0):
+    """Lift `n` random positions of the source genome and compare them with
+    the alignment columns of the reconstructed blocks. A position in a
+    consensus column must be lifted to the candidate target occurrences that
+    have a nucleotide in the same column, and a position in an insertion
+    must be unmapped. Returns the number of positions that differ."""
+    O = lo.occ
+    rng = np.random.default_rng(seed)
+    pos = rng.integers(0, O.L[O.isos == source][0], n)
+    res = lo.lift_points(source, target, pos)
+    lifted = res[res["status"] != "unmapped"].groupby("idx")["pos"].apply(set)
+
+    src_occ, seq_pos = lo.locate(source, pos)
+    row, cand = lo.targets(src_occ, target)
+    alns = {}
+    n_diff = 0
+    for i, (o, q) in enumerate(zip(src_occ, seq_pos)):
+        bid = O.occ_bids[o]
+        if bid not in alns:
+            aln = pan.blocks[bid].alignment
+            seqs, occs = aln.generate_alignments()
+            A = {(iso, num): np.array(list(s)) for s, (iso, num, _) in zip(seqs, occs)}
+            alns[bid] = A, consensus_columns(len(aln.consensus), aln.gaps)
+        A, is_cons = alns[bid]
+        c = np.flatnonzero(A[(O.isos[o], O.nums[o])] != "-")[q]
+        expected = set()
+        for t in cand[row == i] if is_cons[c] else []:
+            t_row = A[(O.isos[t], O.nums[t])]
+            if t_row[c] != "-":
+                t_seq = np.count_nonzero(t_row[:c] != "-")
+                expected.add(int(lo.genome_positions(t, t_seq)))
+        n_diff += expected != lifted.get(i, set())
+    return n_diff
+
+
+def lift_bed_chunk(lo, args, bed):
+    """Lift a chunk of BED records. Returns the lifted and unmapped records."""
+    on_source = (bed[0] == args.source).to_numpy()
+    src = bed[on_source]
+    res = lo.lift_intervals(args.source, args.target, src[1], src[2])
+    ok = (res["status"] == "ok").to_numpy()
+
+    out = src[ok].copy()
+    r = res[ok]
+    out[0] = args.target
+    out[1] = r["start"].to_numpy()
+    out[2] = r["end"].to_numpy()
+    if out.shape[1] >= 6:
+        # flip the strand of the record on inverted blocks
+        inv = (r["strand"] == "-").to_numpy()
+        flip = {"+": "-", "-": "+"}
+        out.loc[inv, 5] = out.loc[inv, 5].map(lambda x: flip.get(x, x))
+
+    # intervals that cross the origin of the target are split in two
+    wrap = (out[2] < out[1]).to_numpy()
+    if wrap.any():
+        L = lo.occ.L[lo.occ.isos == args.target][0]
+        head, tail = out[wrap].copy(), out[wrap].copy()
+        head[2] = L
+        tail[1] = 0
+        out = pd.concat([out[~wrap], head, tail]).sort_index(kind="stable")
+
+    unmapped = src[~ok].assign(status=res["status"][~ok].to_numpy())
+    other = bed[~on_source].assign(status="other_chrom")
+    return out, pd.concat([unmapped, other])
+
+
+def lift_csv_chunk(lo, args, df):
+    res = lo.lift_points(args.source, args.target, df["pos"].to_numpy())
+    res = res.rename(columns={"pos": "target_pos", "strand": "target_strand"})
+    res = res[["idx", "target_pos", "target_strand", "n_hits", "status"]]
+    out = df.reset_index(drop=True).iloc[res["idx"]].reset_index(drop=True)
+    out = pd.concat([out, res.drop(columns="idx")], axis=1)
+    mask = out["status"] == "unmapped"
+    return out[~mask], out[mask]
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    # the check needs the consensus of the blocks, not kept in the cache
+    pan = gc.load_graph(args.graph, alignments=args.check is not None)
+    Ls = pd.read_csv(args.seq_lengths).set_index("id")["length"].to_dict()
+    P = tio.read_table(args.block_positions)
+    P.set_index(["genome", "block_id", "occurrence_number"], inplace=True)
+    msu = pd.read_csv(args.msu) if args.msu is not None else None
+    lo = Liftover(pan, Ls, P, msu)
+
+    if args.check is not None:
+        n_diff = check_columns(lo, pan, args.source, args.target, args.check)
+        print(f"{n_diff} of {args.check} lifted positions differ from the alignment")
+        raise SystemExit(n_diff > 0)
+
+    if args.format == "bed":
+        kwargs = dict(sep="\t", header=None, comment="#")
+        reader = pd.read_csv(args.input, chunksize=args.chunksize, **kwargs)
+        lift_chunk = lift_bed_chunk
+        sep = "\t"
+    else:
+        reader = pd.read_csv(args.input, chunksize=args.chunksize)
+        lift_chunk = lift_csv_chunk
+        sep = ","
+
+    # records are processed and written one chunk at a time
+    for n, chunk in enumerate(reader):
+        out, unmapped = lift_chunk(lo, args, chunk)
+        kwargs = dict(
+            sep=sep,
+            mode="w" if n == 0 else "a",
+            header=(args.format == "csv") and (n == 0),
+            index=False,
+        )
+        out.to_csv(args.output, **kwargs)
+        if args.unmapped is not None:
+            unmapped.to_csv(args.unmapped, **kwargs)
@@ -1,11 +1,23 @@
 # %%
 import numpy as np
 import pandas as pd
-import pypangraph as pp
+import graph_cache as gc
+import aln_archive as aa
+import aln_cache as ac
 from Bio import SeqIO, Seq, SeqRecord
 import pathlib
 import matplotlib.pyplot as plt
 import argparse
+import contextlib
+import collections
+
+GAP = ord("-")
+
+# complement of the IUPAC nucleotide codes, as a byte translation table
+COMPLEMENT = np.arange(256, dtype=np.uint8)
+COMPLEMENT[list(b"ACGTRYKMBVDHSWNacgtrykmbvdhswn")] = list(
+    b"TGCAYRMKVBHDSWNtgcayrmkvbhdswn"
+)
 
 
 def parse_args():
@@ -16,22 +28,43 @@ def parse_args():
     parser.add_argument("--out_aln_fld", type=str, help="Output alignment folder")
     parser.add_argument("--out_plot", type=str, help="Output plot file")
     parser.add_argument("--out_info", type=str, help="Output info file")
+    parser.add_argument(
+        "--archive",
+        action="store_true",
+        help="Save all alignments in a single indexed archive, not one fasta each",
+    )
+    parser.add_argument(
+        "--aln_cache", type=str, help="Shared cache of reconstructed alignments"
+    )
+    parser.add_argument(
+        "--aln_cache_gb", type=float, help="Size cap of the alignment cache (GB)"
+    )
     return parser.parse_args()
 
 
 def load_args():
     args = parse_args()
-    pan = pp.Pangraph.load_json(args.graph)
-    seq_lengths = pd.read_csv(args.seq_lengths).set_index("id")["length"].to_dict()
     msu = pd.read_csv(args.msu)
+    pan = gc.load_graph(args.graph, alignments=True, blocks=msu_blocks(msu))
+    seq_lengths = pd.read_csv(args.seq_lengths).set_index("id")["length"].to_dict()
+    msu_dict, sign_dict, msu = msu_tables(pan, msu)
+
+    return pan, seq_lengths, msu_dict, sign_dict, msu
+
+
+def msu_blocks(msu):
+    # blocks whose alignment is needed
+    return set(msu.loc[msu["msu"] != 0, "bid"])
+
+
+def msu_tables(pan, msu):
     check_signatures(msu)
     k1, k2 = pan.strains()
     mask = (msu["path"] == k2) & (msu["msu"] != 0)
     sign_dict = msu[mask].set_index("signature")
-    msu.set_index(["path", "bid", "strand", "occ"], inplace=True)
+    msu = msu.set_index(["path", "bid", "strand", "occ"])
     msu_dict = msu["msu"].to_dict()
-
-    return pan, seq_lengths, msu_dict, sign_dict, msu
+    return msu_dict, sign_dict, msu
 
 
 def check_signatures(msu):
@@ -50,86 +83,118 @@ def extract_pathinfo(pan, path):
     return blocks, strands, nums
 
 
-def msu_extremes(B, S, O, k, m, msu_dict):
-    # get start and end indices of an msu in a path
-    s, e = None, None
-    i, N = 0, len(B)
-    while (s is None) or (e is None):
-        idx = (k, B[i], S[i], O[i])
-        j = (i + 1) % N
-        next_idx = (k, B[j], S[j], O[j])
-        mi = msu_dict[idx]
-        mj = msu_dict[next_idx]
-
-        if (mi == m) and (mj != m):
-            e = i
-        elif (mi != m) and (mj == m):
-            s = j
-        i = j
-    return s, e
+def msu_runs(pan, k, msu_dict, L):
+    """Extent of every MSU along path `k`, found in a single pass over the
+    path. Returns a dataframe indexed by MSU with the index of the first
+    and last block occurrence (`end_idx` < `start_idx` for the MSU that
+    wraps around the origin of the circular path), the start coordinate
+    and the length in bp on genome `k`, of length `L`."""
+    B, S, O = extract_pathinfo(pan, k)
+    N = len(B)
+    m = np.array([msu_dict[(k, b, s, o)] for b, s, o in zip(B, S, O)])
+
+    # runs of consecutive occurrences in the same MSU, which can wrap
+    # around the origin
+    change = m != np.roll(m, 1)
+    if not change.any():
+        change[0] = True
+    rs = np.flatnonzero(change)
+    re_ = (np.roll(rs, -1) - 1) % N
+    keep = m[rs] != 0
+    rs, re_ = rs[keep], re_[keep]
+    assert len(np.unique(m[rs])) == len(rs), "MSUs must be contiguous in a path"
+
+    P = np.asarray(pan.paths[k].block_positions)
+    start, end = P[rs], P[(re_ + 1) % N]
+    length = (end - start) % L
+    length[length == 0] = L
+    df = pd.DataFrame(
+        {
+            "start_idx": rs,
+            "end_idx": re_,
+            "start_pos": start,
+            "length": length,
+        },
+        index=pd.Index(m[rs], name="msu"),
+    )
+    return df.sort_index()
 
 
-def aln_matrix(aln1, aln2):
-    align_matrix = np.array([list(aln1), list(aln2)])
-    mask = np.any(align_matrix != "-", axis=0)
-    align_matrix = align_matrix[:, mask]
-    return align_matrix
+def aln_records(A, m, k1, k2):
+    aln1 = A[0].tobytes().decode()
+    aln2 = A[1].tobytes().decode()
+    rec1 = SeqRecord.SeqRecord(seq=Seq.Seq(aln1), id=f"MSU_{m}_{k1}")
+    rec2 = SeqRecord.SeqRecord(seq=Seq.Seq(aln2), id=f"MSU_{m}_{k2}")
+    return [rec1, rec2]
 
 
-def save_aln(A, m, k1, k2, svfld):
+def save_aln(A, m, k1, k2, svfld, archive=None):
+    # save in the archive writer `archive` if given, otherwise as fasta
+    records = aln_records(A, m, k1, k2)
+    if archive is not None:
+        archive.add(f"MSU_{m}", records)
+        return
     svfld = pathlib.Path(svfld)
     svfld.mkdir(exist_ok=True, parents=True)
-    aln1 = "".join(A[0, :])
-    aln2 = "".join(A[1, :])
-    rec1 = SeqRecord.SeqRecord(seq=Seq.Seq(aln1), id=f"MSU_{m}_{k1}")
-    rec2 = SeqRecord.SeqRecord(seq=Seq.Seq(aln2), id=f"MSU_{m}_{k2}")
-    SeqIO.write([rec1, rec2], svfld / f"MSU_{m}.fa", "fasta")
+    SeqIO.write(records, svfld / f"MSU_{m}.fa", "fasta")
 
 
 def SNPs(A):
-    mask = np.all(A != "-", axis=0)
+    mask = np.all(A != GAP, axis=0)
     mask &= A[0] != A[1]
     snp_idxs = np.where(mask)[0]
     return snp_idxs
 
 
 def Dels(A):
-    mask = A[0] == "-"
-    assert np.all(A[1, mask] != "-")
+    mask = A[0] == GAP
+    assert np.all(A[1, mask] != GAP)
     del_idxs = np.where(mask)[0]
     return del_idxs
 
 
 def Ins(A):
-    mask = A[1] == "-"
-    assert np.all(A[0, mask] != "-")
+    mask = A[1] == GAP
+    assert np.all(A[0, mask] != GAP)
     ins_idxs = np.where(mask)[0]
     return ins_idxs
 
 
-def plot(As, start_pos, L, k1):
-
-    kwargs = dict(
-        histtype="step",
-        cumulative=True,
-    )
-
-    ms = sorted(As)
-    N = len(ms)
-    fig, axs = plt.subplots(N, 1, figsize=(10, 2 * N))
-    for y, m in enumerate(ms):
-        ax = axs[y]
-        A = As[m]
-        bins = np.linspace(0, A.shape[1] + 2, 1000)
-        snps, ins, dels = SNPs(A), Ins(A), Dels(A)
-        ax.hist(snps, bins=bins, color="C0", label="SNPs", **kwargs)
-        ax.hist(ins, bins=bins, color="C1", label="ins", **kwargs)
-        ax.hist(dels, bins=bins, color="C2", label="dels", **kwargs)
+# number of bins of the mutation histograms in the plot
+N_BINS = 1000
+# mutation kinds, with plot color and label
+MUT_KINDS = [("snps", "C0", "SNPs"), ("ins", "C1", "ins"), ("dels", "C2", "dels")]
+
+
+def mutation_summary(m, A):
+    """Compact summary of the alignment of MSU `m`: number of SNPs,
+    insertions and deletions and their histogram along the alignment. It
+    is all that the plot and the info table need, so that the alignment
+    can be freed."""
+    bins = np.linspace(0, A.shape[1] + 2, N_BINS)
+    summ = {"msu": m, "len_aln": A.shape[1], "bins": bins}
+    for k, f in [("snps", SNPs), ("ins", Ins), ("dels", Dels)]:
+        idxs = f(A)
+        summ[k] = len(idxs)
+        summ[f"{k}_hist"] = np.histogram(idxs, bins=bins)[0].astype(np.int32)
+    return summ
+
+
+def plot(summaries, start_pos, L, k1):
+
+    N = len(summaries)
+    fig, axs = plt.subplots(N, 1, figsize=(10, 2 * N), squeeze=False)
+    axs = axs[:, 0]
+    for ax, summ in zip(axs, summaries):
+        m, La, bins = summ["msu"], summ["len_aln"], summ["bins"]
+        for k, c, lab in MUT_KINDS:
+            # cumulative step histogram
+            ax.stairs(np.cumsum(summ[f"{k}_hist"]), bins, color=c, label=lab)
         xticks = ax.get_xticks()
         xlabels = [f"{(int(x) + start_pos[m]) % L}" for x in xticks]
         ax.set_xticks(xticks)
         ax.set_xticklabels(xlabels)
-        if start_pos[m] + A.shape[1] > L:
+        if start_pos[m] + La > L:
             ax.axvline(L - start_pos[m], color="k", lw=1, ls="--")
             ax.text(
                 L - start_pos[m] + 1,
@@ -140,9 +205,9 @@ def plot(As, start_pos, L, k1):
                 rotation=90,
                 color="k",
             )
-        ax.set_xlim(0, A.shape[1] + 2)
+        ax.set_xlim(0, La + 2)
         ax.set_ylim(bottom=0)
-        ax.set_ylabel(f"MSU {m} L={A.shape[1]/1000:.0f} kb")
+        ax.set_ylabel(f"MSU {m} L={La/1000:.0f} kb")
         # despine
         ax.spines["top"].set_visible(False)
         ax.spines["right"].set_visible(False)
@@ -153,51 +218,136 @@ def plot(As, start_pos, L, k1):
     return fig, axs
 
 
-def MSUs_info(As):
-    df = []
-    for m in sorted(As):
-        A = As[m]
-        snps, ins, dels = SNPs(A), Ins(A), Dels(A)
-        df.append(
-            {
-                "msu": m,
-                "snps": len(snps),
-                "ins": len(ins),
-                "dels": len(dels),
-                "len_aln": A.shape[1],
-            }
-        )
-    return pd.DataFrame(df)
+def MSUs_info(summaries):
+    cols = ["msu", "snps", "ins", "dels", "len_aln"]
+    return pd.DataFrame([{k: summ[k] for k in cols} for summ in summaries])
 
 
-def extract_alns(pan, k1, k2, m, msu_dict, sign_dict, msu):
-    B1, S1, O1 = extract_pathinfo(pan, k1)
-    s, e = msu_extremes(B1, S1, O1, k1, m, msu_dict)
-    i = s
-    aln1, aln2 = "", ""
-    while i != ((e + 1) % len(B1)):
-        b1, s1, o1 = B1[i], S1[i], O1[i]
-        idx1 = (k1, b1, s1, o1)
-        sig = msu.loc[idx1, "signature"]
-        idx2 = tuple(sign_dict.loc[sig][["path", "bid", "strand", "occ"]])
-        b2, s2, o2 = idx2[1:]
-        assert msu_dict[idx1] == m, f"Expected {m} but got {msu_dict[idx1]}"
-        assert msu_dict[idx2] == m, f"Expected {m} but got {msu_dict[idx2]}"
+def to_bytes(seq):
+    return np.frombuffer(seq.encode(), dtype=np.uint8)
 
-        aln = pan.blocks[b1].alignment
-        aln = dict(zip(*aln.generate_alignments()[::-1]))
-        seq1 = Seq.Seq(aln[(k1, o1, s1)])
-        seq2 = Seq.Seq(aln[(k2, o2, s2)])
 
-        if not s1:
-            seq1 = seq1.reverse_complement()
-            seq2 = seq2.reverse_complement()
+class BlockAlignments:
+    """Gapped sequences of each block as uint8 arrays, indexed by
+    occurrence. Alignments are memoized, so that blocks appearing in
+    several MSUs are reconstructed once. Least recently used blocks are
+    dropped when the memo grows above `max_bytes`."""
 
-        aln1 += str(seq1)
-        aln2 += str(seq2)
+    def __init__(self, pan, cache=None, digests=None, max_bytes=1 << 28):
+        self.pan = pan
+        self.cache = cache
+        self.digests = {} if digests is None else digests
+        self.max_bytes = max_bytes
+        self.memo = collections.OrderedDict()
+        self.size = 0
 
-        i = (i + 1) % len(B1)
-    return aln1, aln2
+    def __getitem__(self, bid):
+        if bid in self.memo:
+            self.memo.move_to_end(bid)
+            return self.memo[bid]
+        aln = self.pan.blocks[bid].alignment
+        seqs, occs = ac.generate_alignments(
+            bid, aln, self.digests.get(bid), self.cache
+        )
+        res = {tuple(o): to_bytes(seq) for seq, o in zip(seqs, occs)}
+        self.memo[bid] = res
+        self.size += sum(len(x) for x in res.values())
+        while self.size > self.max_bytes and len(self.memo) > 1:
+            _, old = self.memo.popitem(last=False)
+            self.size -= sum(len(x) for x in old.values())
+        return res
+
+
+def partner_occurrences(msu, sign_dict):
+    """For every block occurrence in a MSU, the (path, bid, strand, occ)
+    occurrence of the second genome with the same signature."""
+    cols = ["path", "bid", "strand", "occ"]
+    other = dict(zip(sign_dict.index, sign_dict[cols].itertuples(index=False)))
+    in_msu = msu[msu["msu"] != 0]
+    sigs = in_msu["signature"]
+    return {idx: tuple(other[sig]) for idx, sig in zip(in_msu.index, sigs)}
+
+
+def extract_alns(pan, k1, m, s, e, msu_dict, partner, block_alns):
+    """Alignment of MSU `m`, spanning occurrences `s` to `e` of path `k1`,
+    as a (2, L) uint8 array with the sequence of the first genome in the
+    first row. Columns that are gaps in both genomes are removed."""
+    B1, S1, O1 = extract_pathinfo(pan, k1)
+    N = len(B1)
+    n = (e - s) % N + 1
+    idxs = [(k1, B1[i % N], S1[i % N], O1[i % N]) for i in range(s, s + n)]
+
+    # gapped sequences of each block, as views on the memoized alignments
+    pieces = []
+    for idx1 in idxs:
+        k, b1, s1, o1 = idx1
+        k2, b2, s2, o2 = idx2 = partner[idx1]
+        assert msu_dict[idx1] == m, f"Expected {m} but got {msu_dict[idx1]}"
+        assert msu_dict[idx2] == m, f"Expected {m} but got {msu_dict[idx2]}"
+        aln = block_alns[b1]
+        pieces.append((aln[(k1, o1, s1)], aln[(k2, o2, s2)], s1))
+
+    # fill a preallocated buffer, reverse-complementing in place
+    L = sum(len(seq1) for seq1, _, _ in pieces)
+    A = np.empty((2, L), dtype=np.uint8)
+    i = 0
+    for seq1, seq2, s1 in pieces:
+        j = i + len(seq1)
+        if s1:
+            A[0, i:j], A[1, i:j] = seq1, seq2
+        else:
+            np.take(COMPLEMENT, seq1[::-1], out=A[0, i:j])
+            np.take(COMPLEMENT, seq2[::-1], out=A[1, i:j])
+        i = j
+
+    mask = A[0] != GAP
+    mask |= A[1] != GAP
+    return A[:, mask]
+
+
+def msu_alignments(
+    pan,
+    Ls,
+    msu_dict,
+    sign_dict,
+    msu,
+    out_aln_fld,
+    archive=False,
+    cache=None,
+    digests=None,
+):
+    """Save the alignment of every MSU in `out_aln_fld` and return the
+    mutations figure and the MSU info dataframe. MSUs are processed one at
+    a time: each alignment is saved and reduced to a `mutation_summary`
+    before the next is assembled, so that memory is bounded by the largest
+    MSU rather than by the whole genome. With `archive` the
+    alignments are stored in a single archive `out_aln_fld/alignments.alnz`.
+    Block alignments are taken from and saved to the alignment `cache`, if
+    any, using the block `digests` (by default taken from the graph)."""
+    k1, k2 = pan.strains()
+    if digests is None:
+        digests = {} if cache is None else ac.block_digests(pan)
+    runs = msu_runs(pan, k1, msu_dict, Ls[k1])
+    partner = partner_occurrences(msu, sign_dict)
+    block_alns = BlockAlignments(pan, cache, digests)
+
+    aw = None
+    if archive:
+        out_aln_fld = pathlib.Path(out_aln_fld)
+        out_aln_fld.mkdir(exist_ok=True, parents=True)
+        aw = aa.ArchiveWriter(out_aln_fld / aa.ARCHIVE_NAME)
+
+    summaries = []
+    with aw if aw is not None else contextlib.nullcontext():
+        for m, s, e in zip(runs.index, runs["start_idx"], runs["end_idx"]):
+            A = extract_alns(pan, k1, m, s, e, msu_dict, partner, block_alns)
+            save_aln(A, m, k1, k2, out_aln_fld, aw)
+            summaries.append(mutation_summary(m, A))
+            del A
+
+    fig, axs = plot(summaries, runs["start_pos"], Ls[k1], k1)
+    df = MSUs_info(summaries)
+    return fig, df
 
 
 if __name__ == "__main__":
@@ -205,25 +355,21 @@ if __name__ == "__main__":
     args = parse_args()
     pan, Ls, msu_dict, sign_dict, msu = load_args()
 
-    k1, k2 = pan.strains()
-    B1, S1, O1 = extract_pathinfo(pan, k1)
-    B2, S2, O2 = extract_pathinfo(pan, k2)
-
-    As, start_pos = {}, {}
-    msus = set(msu["msu"].unique()) - {0}
-    for m in sorted(msus):
-        aln1, aln2 = extract_alns(pan, k1, k2, m, msu_dict, sign_dict, msu)
-
-        A = aln_matrix(aln1, aln2)
-        save_aln(A, m, k1, k2, args.out_aln_fld)
-        As[m] = A
-
-        s, e = msu_extremes(B1, S1, O1, k1, m, msu_dict)
-        start_pos[m] = pan.paths[k1].block_positions[s]
-
-    fig, axs = plot(As, start_pos, Ls[k1], k1)
+    cache = ac.open_cache(args.aln_cache, args.aln_cache_gb)
+    # the streamed graph carries no digests: take them from the binary cache
+    digests = None if cache is None else ac.block_digests(pan, args.graph)
+    fig, df = msu_alignments(
+        pan,
+        Ls,
+        msu_dict,
+        sign_dict,
+        msu,
+        args.out_aln_fld,
+        args.archive,
+        cache,
+        digests,
+    )
     fig.savefig(args.out_plot)
     plt.close(fig)
 
-    df = MSUs_info(As)
     df.to_csv(args.out_info, index=False)
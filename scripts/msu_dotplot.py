@@ -2,7 +2,10 @@
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
-import pypangraph as pp
+from matplotlib.collections import LineCollection
+import matplotlib.colors as mcolors
+from collections import defaultdict
+import graph_cache as gc
 import segment_utils as su
 import argparse
 
@@ -17,12 +20,17 @@ def parse_args():
 
 
 def load_data(args):
-    pan = pp.Pangraph.load_json(args.graph)
+    pan = gc.load_graph(args.graph, blocks=())
     seq_lengths = pd.read_csv(args.seq_lengths).set_index("id")["length"].to_dict()
     msu = pd.read_csv(args.msu)
+    msu_dict, sign_dict = msu_dicts(msu)
+    return pan, seq_lengths, msu_dict, sign_dict
+
+
+def msu_dicts(msu):
     msu_dict = msu.set_index(["path", "bid", "strand", "occ"])["msu"].to_dict()
     sign_dict = msu.set_index(["path", "bid", "strand", "occ"])["signature"].to_dict()
-    return pan, seq_lengths, msu_dict, sign_dict
+    return msu_dict, sign_dict
 
 
 def block_positions(pan):
@@ -39,29 +47,46 @@ def block_positions(pan):
     return block_pos
 
 
-def pbc_plot(seg, c, orient, ax):
-    if seg.x_runover():
-        for s in seg.split_x():
-            pbc_plot(s, c, orient, ax)
-    elif seg.y_runover():
-        for s in seg.split_y():
-            pbc_plot(s, c, orient, ax)
-    else:
-        if seg.e1 == 0:
-            seg.e1 = seg.L1
-        if seg.e2 == 0:
-            seg.e2 = seg.L2
-        ax.plot(seg.x(), seg.y(), color=c, lw=1)
+def occurrence_index(path):
+    # block id -> nodes (bid, strand, occ) of the block along the path
+    idx = defaultdict(list)
+    for n in zip(path.block_ids, path.block_strands, path.block_nums):
+        idx[n[0]].append(n)
+    return idx
+
+
+def add_lines(ax, x0, x1, y0, y1, c):
+    # all pieces of one colour as a single collection. The pieces are
+    # joined in one path with nan breaks, so that backends draw them with a
+    # single path instead of one per piece.
+    xy = np.stack([su.line_coords(x0, x1), su.line_coords(y0, y1)], 1)
+    ax.add_collection(LineCollection([xy], colors=c, linewidths=1))
+
+
+def pbc_plot(seg, colors, ax):
+    # draw the segments of a SegmentArray, split at the genome boundaries,
+    # with one collection per colour
+    x0, x1, y0, y1, idx = seg.split()
+    # colour names that resolve to the same colour (e.g. C1 and C11) share
+    # a collection
+    names, name_idx = np.unique(np.asarray(colors, dtype=str), return_inverse=True)
+    rgba, col_idx = np.unique(
+        mcolors.to_rgba_array(names), axis=0, return_inverse=True
+    )
+    col = col_idx.ravel()[name_idx][idx]
+    order = np.argsort(col, kind="stable")
+    for sel in np.split(order, np.flatnonzero(np.diff(col[order])) + 1):
+        add_lines(ax, x0[sel], x1[sel], y0[sel], y1[sel], rgba[col[sel[0]]])
 
 
 def pbc_plot_priv(seg, c, ax, kind):
-    if seg.s > seg.e:
-        for s in seg.split_x():
-            pbc_plot_priv(s, c, ax, kind)
+    x0, x1, _ = seg.split()
+    zero = np.zeros(len(x0))
+    if kind == "x":
+        add_lines(ax, x0, x1, zero, zero, c)
     else:
-        x = seg.x() if kind == "x" else [0, 0]
-        y = seg.x() if kind == "y" else [0, 0]
-        ax.plot(x, y, color=c, lw=1)
+        add_lines(ax, zero, zero, x0, x1, c)
+    ax.autoscale_view()
 
 
 def create_figure(pan, seq_lengths, msu_dict, sign_dict, block_pos):
@@ -92,13 +117,12 @@ def create_figure(pan, seq_lengths, msu_dict, sign_dict, block_pos):
     Lx = seq_lengths[x_lab]
 
     y_path = pan.paths[y_lab]
-    By = y_path.block_ids
-    Sy = y_path.block_strands
-    Oy = y_path.block_nums
+    y_index = occurrence_index(y_path)
     Ly = seq_lengths[y_lab]
 
     msu_color, msu_n = {}, 0
     msu_labelled = set()
+    segs = []
     for i, (b, s, o) in enumerate(zip(Bx, Sx, Ox)):
         x = block_pos[x_lab][(b, s, o)]
         msu_x = msu_dict[(x_lab, b, s, o)]
@@ -109,9 +133,7 @@ def create_figure(pan, seq_lengths, msu_dict, sign_dict, block_pos):
                 msu_color[msu_x] = f"C{msu_n}"
                 msu_n += 1
             col = msu_color[msu_x]
-        for j, (c, d, p) in enumerate(zip(By, Sy, Oy)):
-            if c != b:
-                continue
+        for c, d, p in y_index.get(b, []):
             y = block_pos[y_lab][(c, d, p)]
             msu_y = msu_dict[(y_lab, c, d, p)]
             sign_y = sign_dict[(y_lab, c, d, p)]
@@ -131,8 +153,11 @@ def create_figure(pan, seq_lengths, msu_dict, sign_dict, block_pos):
                     va="top",
                 )
                 msu_labelled |= {msu_x}
-            seg = su.Segment(x[0], x[1], y[0], y[1], orient, Lx, Ly)
-            pbc_plot(seg, col, orient, ax)
+            segs.append((x[0], x[1], y[0], y[1], orient, col))
+
+    if segs:
+        *ends, colors = zip(*segs)
+        pbc_plot(su.SegmentArray(*ends, Lx, Ly), colors, ax)
 
     # set minor ticks every 1e5 bp
     ax.set_xticks(np.arange(0, Lx, 1e5), minor=True)
@@ -152,12 +177,10 @@ def create_figure(pan, seq_lengths, msu_dict, sign_dict, block_pos):
         S = path.block_strands
         O = path.block_nums
         P = path.block_positions
-        N = len(B)
-        for i, (b, s, o) in enumerate(zip(B, S, O)):
-            if b in private:
-                pos = block_pos[lab][(b, s, o)]
-                seg = su.PrivSegment(pos[0], pos[1], seq_lengths[lab])
-                pbc_plot_priv(seg, "red", ax, "x" if lab == x_lab else "y")
+        pos = [block_pos[lab][n] for n in zip(B, S, O) if n[0] in private]
+        if pos:
+            seg = su.PrivSegmentArray(*zip(*pos), seq_lengths[lab])
+            pbc_plot_priv(seg, "red", ax, "x" if lab == x_lab else "y")
 
         ax.grid(True, alpha=0.3)
         ax.grid(which="minor", alpha=0.1)
@@ -1,7 +1,8 @@
 # %%
 import pandas as pd
 import numpy as np
-import pypangraph as pp
+import graph_cache as gc
+import table_io as tio
 import pathlib
 import argparse
 
@@ -33,9 +34,11 @@ def parse_args():
         required=True,
     )
     parser.add_argument(
+        "--out",
         "--out_csv",
+        dest="out",
         type=str,
-        help="Path to the output csv file",
+        help="Path to the output file (.csv or .parquet)",
         required=True,
     )
     args = parser.parse_args()
@@ -43,18 +46,18 @@ def parse_args():
 
 
 def load_dfs(args):
-    pan = pp.Pangraph.load_json(args.graph)
+    pan = gc.load_graph(args.graph, blocks="core")
 
     fld_name = pathlib.Path(args.core_alignments)
-    I = pd.read_csv(fld_name / "ins.csv")
-    D = pd.read_csv(fld_name / "dels.csv")
-    M = pd.read_csv(fld_name / "snps.csv")
+    I = tio.read_table(tio.find_table(fld_name, "ins"))
+    D = tio.read_table(tio.find_table(fld_name, "dels"))
+    M = tio.read_table(tio.find_table(fld_name, "snps"))
 
     fname = args.lengths
     Ls = pd.read_csv(fname).set_index("id")["length"].to_dict()
 
     fname = args.block_positions
-    P = pd.read_csv(fname)
+    P = tio.read_table(fname)
     P.set_index(["genome", "block_id", "occurrence_number"], inplace=True)
 
     return pan, I, D, M, Ls, P
@@ -81,41 +84,122 @@ def seq_pos_to_genome_pos(block_strand, block_start, block_end, seq_pos, L):
         return (block_end - seq_pos) % L
 
 
-if __name__ == "__main__":
-    args = parse_args()
-    pan, I, D, M, Ls, P = load_dfs(args)
+class OccurrenceIndex:
+    """Occurrences of a set of blocks, with the position of each occurrence
+    in the genome and the sorted cumulative insertion/deletion offsets
+    needed to convert alignment positions into sequence positions."""
+
+    def __init__(self, pan, bids, Ls, P):
+        self.bids = pd.Index(bids)
+        isos, nums, ins, dels = [], [], [], []
+        self.block_occ_offsets = [0]
+        for bid in self.bids:
+            aln = pan.blocks[bid].alignment
+            for o in aln.occs:
+                iso, num, _ = o
+                isos.append(iso)
+                nums.append(num)
+                ins.append([(i0, len(seq)) for (i0, _), seq in aln.ins.get(o, [])])
+                dels.append(list(aln.dels.get(o, [])))
+            self.block_occ_offsets.append(len(isos))
+        self.block_occ_offsets = np.array(self.block_occ_offsets, dtype=np.int64)
+        self.isos = np.array(isos, dtype=object)
+        self.nums = np.array(nums, dtype=np.int64)
+        self.occ_bids = np.repeat(
+            self.bids.to_numpy(dtype=object), np.diff(self.block_occ_offsets)
+        )
+
+        # genome position of every occurrence, from the block positions table
+        idx = pd.MultiIndex.from_arrays([self.isos, self.occ_bids, self.nums])
+        Pocc = P.reindex(idx)
+        self.strand = Pocc["strand"].to_numpy(dtype=bool)
+        self.start = Pocc["start_position"].to_numpy(dtype=np.int64)
+        self.end = Pocc["end_position"].to_numpy(dtype=np.int64)
+        self.L = np.array([Ls[iso] for iso in isos], dtype=np.int64)
+
+        # positions are encoded as occ * K + pos, with K larger than any
+        # indel position so that keys of different occurrences never overlap
+        max_pos = max([p for xs in ins + dels for p, _ in xs], default=0)
+        self.K = max_pos + 2
+        self.ins = self.offsets(ins)
+        self.dels = self.offsets(dels)
+
+    def offsets(self, indels):
+        """Flatten the per-occurrence (position, length) lists into sorted
+        keys occ * K + position and the cumulative sum of the lengths."""
+        n = np.array([len(x) for x in indels], dtype=np.int64)
+        flat = [x for xs in indels for x in xs]
+        pos = np.array([x[0] for x in flat], dtype=np.int64)
+        lens = np.array([x[1] for x in flat], dtype=np.int64)
+        occ = np.repeat(np.arange(len(indels), dtype=np.int64), n)
+        keys = occ * self.K + pos
+        order = np.argsort(keys, kind="stable")
+        cum = np.concatenate([[0], np.cumsum(lens[order])])
+        first = np.concatenate([[0], np.cumsum(n)])
+        return keys[order], cum, first
+
+    def shift(self, occ, aln_pos, indels):
+        # total length of the indels of occurrence `occ` found strictly
+        # before `aln_pos`. Positions past the last indel are clipped to K-1
+        keys, cum, first = indels
+        q = occ * self.K + np.minimum(aln_pos, self.K - 1)
+        j = np.searchsorted(keys, q, side="left")
+        return cum[j] - cum[first[occ]]
+
+    def expand(self, bids):
+        """For every block id in `bids` return the list of its occurrences:
+        the index of the original entry and the occurrence index."""
+        b = self.bids.get_indexer(bids).astype(np.int64)
+        o0 = self.block_occ_offsets[b]
+        n = self.block_occ_offsets[b + 1] - o0
+        row = np.repeat(np.arange(len(b)), n)
+        rank = np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n)
+        return row, np.repeat(o0, n) + rank
+
+    def genome_positions(self, occ, aln_pos):
+        seq_pos = aln_pos + self.shift(occ, aln_pos, self.ins)
+        seq_pos -= self.shift(occ, aln_pos, self.dels)
+        L = self.L[occ]
+        fwd = (self.start[occ] + seq_pos) % L
+        rev = (self.end[occ] - seq_pos) % L
+        return np.where(self.strand[occ], fwd, rev)
+
+
+def mutations_positions(pan, I, D, M, Ls, P):
+    bids = pd.unique(pd.concat([X["block_id"] for X in [M, I, D]]))
+    occ_idx = OccurrenceIndex(pan, bids, Ls, P)
 
     res = []
     for X, tp in [(M, "snp"), (I, "ins"), (D, "del")]:
-        for idx, row in X.iterrows():
-            bid = row["block_id"]
-            main_iso = row["iso"]
-            main_occ = row["block_num"]
-            consensus_pos = row["block_aln_pos"]
-            aln = pan.blocks[bid].alignment
+        row, occ = occ_idx.expand(X["block_id"].to_numpy())
+        aln_pos = X["block_aln_pos"].to_numpy(dtype=np.int64)[row]
+        genome_pos = occ_idx.genome_positions(occ, aln_pos)
+        isos = occ_idx.isos[occ]
+        nums = occ_idx.nums[occ]
+        is_main = (X["iso"].to_numpy()[row] == isos) & (
+            X["block_num"].to_numpy()[row] == nums
+        )
+        res.append(
+            pd.DataFrame(
+                {
+                    "mut_idx": X.index.to_numpy()[row],
+                    "mut_type": tp,
+                    "genome": isos,
+                    "block_id": occ_idx.occ_bids[occ],
+                    "occurrence_number": nums,
+                    "strand": occ_idx.strand[occ],
+                    "genome_pos": genome_pos,
+                    "block_aln_pos": aln_pos,
+                    "is_main": is_main.astype(bool),
+                }
+            )
+        )
+    return pd.concat(res, ignore_index=True)
 
-            for o in aln.occs:
-                iso, num, b_strand = o
-
-                b_strand, b_start, b_end = P.loc[(iso, bid, num)]
-
-                seq_pos = aln_pos_to_seq_pos(consensus_pos, aln.ins[o], aln.dels[o])
-                genome_pos = seq_pos_to_genome_pos(
-                    b_strand, b_start, b_end, seq_pos, Ls[iso]
-                )
-
-                res.append(
-                    {
-                        "mut_idx": idx,
-                        "mut_type": tp,
-                        "genome": iso,
-                        "block_id": bid,
-                        "occurrence_number": num,
-                        "strand": b_strand,
-                        "genome_pos": genome_pos,
-                        "block_aln_pos": consensus_pos,
-                        "is_main": main_iso == iso and main_occ == num,
-                    }
-                )
-    res = pd.DataFrame(res)
-    res.to_csv(args.out_csv, index=False)
+
+if __name__ == "__main__":
+    args = parse_args()
+    pan, I, D, M, Ls, P = load_dfs(args)
+
+    res = mutations_positions(pan, I, D, M, Ls, P)
+    tio.write_table(res, args.out, partition_by="block_id")
@@ -0,0 +1,186 @@
+import graph_cache as gc
+import seq_lengths as sl
+import numpy as np
+import argparse
+import json
+
+GAP = ord("-")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Restrict a multi-genome pangraph to a subset of genomes"
+    )
+    parser.add_argument("--graph", type=str, help="Pangraph JSON file", required=True)
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument(
+        "--genomes",
+        type=str,
+        nargs="+",
+        help="Names of the paths to keep. Paths are saved in this order.",
+    )
+    group.add_argument(
+        "--fastas",
+        type=str,
+        nargs="+",
+        help="Keep the paths of the records of these fasta files, in order.",
+    )
+    parser.add_argument("--out", type=str, help="Output JSON file", required=True)
+    return parser.parse_args()
+
+
+def fasta_ids(fasta_file):
+    # record ids, as in the paths of the graph built from the file
+    with sl.open_fasta(fasta_file) as f:
+        return [l[1:].split()[0].decode() for l in f if l.startswith(b">")]
+
+
+def is_node_list(v):
+    # block entries with one [node, data] item per occurrence (mutate,
+    # insert, delete, ...)
+    return (
+        isinstance(v, list)
+        and len(v) > 0
+        and all(isinstance(x, list) and len(x) > 0 for x in v)
+        and all(isinstance(x[0], dict) for x in v)
+        and all("name" in x[0] for x in v)
+    )
+
+
+def runs(mask):
+    # start and end (excluded) of the runs of True values
+    d = np.diff(np.concatenate([[0], mask.astype(np.int8), [0]]))
+    return np.flatnonzero(d == 1), np.flatnonzero(d == -1)
+
+
+def alignment_matrix(block, nodes):
+    """Alignment of the occurrences `nodes` of the block, one row each as
+    ascii codes, together with the consensus row (gaps outside of the
+    consensus columns). Positions in the block are 1-based, and gap `g`
+    holds the insertions after consensus position `g`, as in pangraph."""
+    muts, ins, dels = (
+        {gc.node_key(n): v for n, v in block[k]}
+        for k in ["mutate", "insert", "delete"]
+    )
+    L = len(block["sequence"])
+    gaps = {}
+    for ii in ins.values():
+        for (g, start), seq in ii:
+            gaps[g] = max(gaps.get(g, 0), start + len(seq))
+
+    # column of each consensus position, and first column of each gap
+    width = np.ones(L + 1, dtype=np.int64)
+    width[0] = 0
+    for g, n in gaps.items():
+        width[g] += n
+    ends = np.cumsum(width)
+    cons_col = ends[:-1]
+    gap_col = {g: ends[g] - n for g, n in gaps.items()}
+
+    ref = np.full(ends[-1], GAP, dtype=np.uint8)
+    ref[cons_col] = np.frombuffer(block["sequence"].encode(), dtype=np.uint8)
+    A = np.tile(ref, (len(nodes), 1))
+    for r, node in zip(A, nodes):
+        k = gc.node_key(node)
+        for pos, alt in muts[k]:
+            r[cons_col[pos - 1]] = ord(alt)
+        for pos, n in dels[k]:
+            r[cons_col[pos - 1 : pos - 1 + n]] = GAP
+        for (g, start), seq in ins[k]:
+            c = gap_col[g] + start
+            r[c : c + len(seq)] = np.frombuffer(seq.encode(), dtype=np.uint8)
+    return A, ref
+
+
+def encode_row(r, cons, is_cons, cpos, cons_idx):
+    # mutations, insertions and deletions of one aligned occurrence
+    c = np.flatnonzero(is_cons & (r != GAP) & (r != cons))
+    muts = [[int(cpos[i]), chr(r[i])] for i in c]
+    s, e = runs(r[is_cons] == GAP)
+    dels = [[int(a) + 1, int(b - a)] for a, b in zip(s, e)]
+    ins = []
+    for a, b in zip(*runs(~is_cons & (r != GAP))):
+        g = int(cpos[a])
+        start = a if g == 0 else a - cons_idx[g - 1] - 1
+        ins.append([[g, int(start)], r[a:b].tobytes().decode()])
+    return muts, ins, dels
+
+
+def rebase_block(block):
+    """Re-encode the block on a consensus of its own occurrences. Columns
+    that are gaps in every occurrence are dropped, insertions shared by all
+    occurrences become consensus positions and the consensus takes the
+    nucleotide of the occurrences wherever they agree. Mutations and indels
+    then only mark differences between the remaining occurrences."""
+    nodes = [n for n, _ in block["mutate"]]
+    A, ref = alignment_matrix(block, nodes)
+    keep = (A != GAP).any(axis=0)
+    A, ref = A[:, keep], ref[keep]
+    if len(A) == 0 or not (ref != GAP).any():
+        return block
+
+    is_cons = (ref != GAP) | (A != GAP).all(axis=0)
+    # nucleotide of the occurrences where they agree, otherwise the panel
+    # consensus if some occurrence carries it
+    first = A[(A != GAP).argmax(axis=0), np.arange(A.shape[1])]
+    agree = ((A == first) | (A == GAP)).all(axis=0)
+    has_ref = (A == ref).any(axis=0)
+    cons = np.where(~agree & has_ref, ref, first)
+
+    cpos = np.cumsum(is_cons)
+    cons_idx = np.flatnonzero(is_cons)
+    block["sequence"] = cons[is_cons].tobytes().decode()
+    g, n = np.unique(cpos[~is_cons], return_counts=True)
+    block["gaps"] = {str(k): int(v) for k, v in zip(g, n)}
+    encoded = [encode_row(r, cons, is_cons, cpos, cons_idx) for r in A]
+    for i, k in enumerate(["mutate", "insert", "delete"]):
+        block[k] = [[node, e[i]] for node, e in zip(nodes, encoded)]
+    return block
+
+
+def project_block(block, genomes):
+    """Copy of the block with only the occurrences in `genomes`, rebased on
+    their consensus, or None if the block does not occur in any of them."""
+    block = dict(block)
+    for k, v in list(block.items()):
+        if is_node_list(v):
+            block[k] = [x for x in v if x[0]["name"] in genomes]
+    if len(block["mutate"]) == 0:
+        return None
+    return rebase_block(block)
+
+
+def project_graph(graph_file, genomes):
+    """Stream-parse a pangraph json and keep only the paths of `genomes` and
+    the blocks occurring in them. Blocks are re-encoded on the consensus of
+    the remaining occurrences, so that mutations and indels are differences
+    between `genomes` only. Core, accessory and duplicated status are
+    recomputed by the downstream scripts from the remaining occurrences."""
+    genomes = list(genomes)
+    keep = set(genomes)
+    paths, blocks = {}, []
+    with open(graph_file, "r") as f:
+        for key, item in gc.JSONStream(f).items():
+            if key == "paths":
+                if item["name"] in keep:
+                    paths[item["name"]] = item
+            elif key == "blocks":
+                block = project_block(item, keep)
+                if block is not None:
+                    blocks.append(block)
+
+    missing = keep - set(paths)
+    if missing:
+        raise ValueError(f"genomes {sorted(missing)} not found in {graph_file}")
+    return {"paths": [paths[g] for g in genomes], "blocks": blocks}
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    genomes = args.genomes
+    if genomes is None:
+        genomes = [i for fa in args.fastas for i in fasta_ids(fa)]
+    pan_json = project_graph(args.graph, genomes)
+    with open(args.out, "w") as f:
+        json.dump(pan_json, f)
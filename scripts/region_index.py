@@ -0,0 +1,261 @@
+import numpy as np
+import pandas as pd
+import table_io as tio
+import argparse
+import json
+import re
+
+KINDS = ["blocks", "msu", "mutations"]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Build or query the index of blocks, MSUs and mutations"
+    )
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    build = sub.add_parser("build", help="Build the region index")
+    build.add_argument("--seq_lengths", type=str, required=True)
+    build.add_argument("--block_positions", type=str, required=True)
+    build.add_argument("--msu", type=str, help="Minimal synteny units CSV file")
+    build.add_argument("--mutations", type=str, help="Mutations positions table")
+    build.add_argument("--out", type=str, help="Output index (.npz)", required=True)
+
+    query = sub.add_parser("query", help="Query features overlapping regions")
+    query.add_argument("--index", type=str, required=True)
+    query.add_argument(
+        "--region",
+        type=str,
+        nargs="+",
+        required=True,
+        help="Regions as genome:start-end (0-based, end excluded). "
+        "start > end wraps around the origin.",
+    )
+    query.add_argument("--kinds", type=str, nargs="+", choices=KINDS, default=KINDS)
+    query.add_argument("--out", type=str, help="Output CSV (default: stdout)")
+    return parser.parse_args()
+
+
+# ---------------- features ----------------
+
+
+def block_features(bpos):
+    return pd.DataFrame(
+        {
+            "genome": bpos["genome"],
+            "start": bpos["start_position"],
+            "end": bpos["end_position"],
+            "block_id": bpos["block_id"],
+            "strand": bpos["strand"],
+            "occurrence_number": bpos["occurrence_number"],
+        }
+    )
+
+
+def msu_features(msu, bpos):
+    """One interval for each run of consecutive blocks of the same MSU along
+    each path. Runs can wrap around the origin of the genome."""
+    P = bpos.set_index(["genome", "block_id", "occurrence_number"])
+    res = []
+    for genome, df in msu.groupby("path", sort=False):
+        idx = pd.MultiIndex.from_arrays([df["path"], df["bid"], df["occ"]])
+        Pg = P.reindex(idx)
+        m = df["msu"].to_numpy()
+        start = Pg["start_position"].to_numpy()
+        end = Pg["end_position"].to_numpy()
+        N = len(m)
+        change = m != np.roll(m, 1)
+        if not change.any():
+            change[0] = True
+        rs = np.nonzero(change)[0]
+        re_ = (np.roll(rs, -1) - 1) % N
+        keep = m[rs] != 0
+        rs, re_ = rs[keep], re_[keep]
+        res.append(
+            pd.DataFrame(
+                {
+                    "genome": genome,
+                    "start": start[rs],
+                    "end": end[re_],
+                    "msu": m[rs],
+                    "n_blocks": (re_ - rs) % N + 1,
+                }
+            )
+        )
+    return pd.concat(res, ignore_index=True)
+
+
+def mutation_features(muts):
+    return pd.DataFrame(
+        {
+            "genome": muts["genome"],
+            "start": muts["genome_pos"],
+            "end": muts["genome_pos"] + 1,
+            "mut_type": muts["mut_type"],
+            "block_id": muts["block_id"],
+            "occurrence_number": muts["occurrence_number"],
+            "block_aln_pos": muts["block_aln_pos"],
+            "is_main": muts["is_main"],
+        }
+    )
+
+
+# ---------------- index ----------------
+
+
+def split_circular(df, Ls):
+    """Split intervals that wrap around the origin (start > end) into two
+    pieces. `feature` keeps the index of the original interval. Intervals
+    with start == end span the whole genome."""
+    df = df.reset_index(drop=True)
+    df["feature"] = np.arange(len(df))
+    df["orig_start"], df["orig_end"] = df["start"], df["end"]
+    L = df["genome"].map(Ls).to_numpy()
+    wrap = (df["start"] >= df["end"]).to_numpy()
+    head = df[wrap].assign(end=L[wrap])
+    tail = df[wrap].assign(start=0)
+    tail = tail[tail["end"] > 0]
+    return pd.concat([df[~wrap], head, tail], ignore_index=True)
+
+
+class RegionIndex:
+    """Per-genome sorted interval arrays. Features that do not overlap
+    within a genome (blocks, MSU runs, mutation sites) have sorted ends as
+    well as starts, and overlap queries binary-search both, in O(log n + k).
+    For other tables the query scans back from the region start by the
+    longest interval of the table."""
+
+    def __init__(self, tables, Ls):
+        self.tables = tables
+        self.Ls = Ls
+        self.genome_bounds = {}
+        self.max_len = {}
+        self.sorted_ends = {}
+        for kind, df in tables.items():
+            g = df["genome"].to_numpy()
+            genomes = pd.unique(g)
+            self.genome_bounds[kind] = {
+                x: (np.searchsorted(g, x, "left"), np.searchsorted(g, x, "right"))
+                for x in genomes
+            }
+            lens = (df["end"] - df["start"]).to_numpy()
+            self.max_len[kind] = int(lens.max(initial=0))
+            e = df["end"].to_numpy()
+            self.sorted_ends[kind] = all(
+                (np.diff(e[g0:g1]) >= 0).all()
+                for g0, g1 in self.genome_bounds[kind].values()
+            )
+
+    @staticmethod
+    def build(feature_tables, Ls):
+        tables = {}
+        for kind, df in feature_tables.items():
+            df = split_circular(df, Ls)
+            df = df.sort_values(["genome", "start"], kind="stable")
+            tables[kind] = df.reset_index(drop=True)
+        return RegionIndex(tables, Ls)
+
+    def save(self, fname):
+        arrays = {"Ls": np.array(json.dumps(self.Ls))}
+        for kind, df in self.tables.items():
+            arrays[f"{kind}/columns"] = np.array(list(df.columns), dtype=str)
+            for c in df.columns:
+                v = df[c].to_numpy()
+                arrays[f"{kind}/{c}"] = v.astype(str) if v.dtype == object else v
+        with open(fname, "wb") as f:
+            np.savez(f, **arrays)
+
+    @staticmethod
+    def load(fname):
+        with np.load(fname) as data:
+            Ls = json.loads(str(data["Ls"]))
+            tables = {}
+            for kind in KINDS:
+                if f"{kind}/columns" not in data.files:
+                    continue
+                cols = data[f"{kind}/columns"]
+                tables[kind] = pd.DataFrame({c: data[f"{kind}/{c}"] for c in cols})
+        return RegionIndex(tables, Ls)
+
+    def _query(self, kind, genome, start, end):
+        # row indices of intervals overlapping [start, end), no wrap
+        if genome not in self.genome_bounds[kind]:
+            return np.array([], dtype=np.int64)
+        g0, g1 = self.genome_bounds[kind][genome]
+        df = self.tables[kind]
+        starts = df["start"].to_numpy()
+        ends = df["end"].to_numpy()
+        i1 = np.searchsorted(starts[g0:g1], end, "left")
+        if self.sorted_ends[kind]:
+            # first interval ending after the region start
+            i0 = np.searchsorted(ends[g0:g1], start, "right")
+            return np.arange(g0 + i0, g0 + max(i0, i1))
+        i0 = np.searchsorted(starts[g0:g1], start - self.max_len[kind], "right")
+        rows = np.arange(g0 + i0, g0 + i1)
+        return rows[ends[rows] > start]
+
+    def query(self, genome, start, end, kinds=KINDS):
+        """Features overlapping the region [start, end) of `genome`. If
+        start > end the region wraps around the origin. Returns a dataframe
+        for each kind of feature, with the original (unsplit) intervals."""
+        L = self.Ls[genome]
+        start = start % L
+        end = end if end == L else end % L
+        if start < end:
+            pieces = [(start, end)]
+        else:
+            pieces = [(start, L), (0, end)]
+        res = {}
+        for kind in kinds:
+            if kind not in self.tables:
+                continue
+            rows = np.unique(
+                np.concatenate([self._query(kind, genome, s, e) for s, e in pieces])
+            )
+            df = self.tables[kind].iloc[rows]
+            res[kind] = self.original(df)
+        return res
+
+    @staticmethod
+    def original(df):
+        # merge back the two pieces of intervals that wrap around the origin
+        df = df.drop_duplicates("feature")
+        df = df.assign(start=df["orig_start"], end=df["orig_end"])
+        return df.drop(columns=["feature", "orig_start", "orig_end"])
+
+
+def parse_region(region):
+    m = re.fullmatch(r"(.+):([\d,_]+)-([\d,_]+)", region)
+    if m is None:
+        raise ValueError(f"region {region} is not in the format genome:start-end")
+    genome, start, end = m.groups()
+    to_int = lambda x: int(x.replace(",", "").replace("_", ""))
+    return genome, to_int(start), to_int(end)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    if args.command == "build":
+        Ls = pd.read_csv(args.seq_lengths).set_index("id")["length"].to_dict()
+        bpos = tio.read_table(args.block_positions)
+        features = {"blocks": block_features(bpos)}
+        if args.msu is not None:
+            features["msu"] = msu_features(pd.read_csv(args.msu), bpos)
+        if args.mutations is not None:
+            muts = tio.read_table(args.mutations)
+            features["mutations"] = mutation_features(muts)
+        RegionIndex.build(features, Ls).save(args.out)
+
+    elif args.command == "query":
+        ri = RegionIndex.load(args.index)
+        res = []
+        for region in args.region:
+            genome, start, end = parse_region(region)
+            for kind, df in ri.query(genome, start, end, args.kinds).items():
+                res.append(df.assign(region=region, kind=kind))
+        res = pd.concat(res, ignore_index=True) if res else pd.DataFrame()
+        if args.out is None:
+            print(res.to_string(index=False))
+        else:
+            res.to_csv(args.out, index=False)
@@ -1,28 +1,23 @@
-import copy
-from dataclasses import dataclass
+import numpy as np
 
 
-@dataclass
-class Segment:
-    s1: int
-    e1: int
-    s2: int
-    e2: int
-    orient: bool
-    L1: int
-    L2: int
+class SegmentArray:
+    """Many segments between two circular genomes of lengths L1 and L2,
+    stored as arrays. Segment i goes from s1[i] to e1[i] on the x genome and
+    from s2[i] to e2[i] on the y genome, in the same direction if orient[i]
+    and in opposite directions otherwise. Ends are taken modulo the genome
+    lengths."""
 
-    def __post_init__(self):
-        self.s1 %= self.L1
-        self.e1 %= self.L1
-        self.s2 %= self.L2
-        self.e2 %= self.L2
+    def __init__(self, s1, e1, s2, e2, orient, L1, L2):
+        self.L1, self.L2 = L1, L2
+        self.s1 = np.asarray(s1, dtype=np.int64) % L1
+        self.e1 = np.asarray(e1, dtype=np.int64) % L1
+        self.s2 = np.asarray(s2, dtype=np.int64) % L2
+        self.e2 = np.asarray(e2, dtype=np.int64) % L2
+        self.orient = np.asarray(orient, dtype=bool)
 
-    def x(self):
-        return (self.s1, self.e1)
-
-    def y(self):
-        return (self.s2, self.e2) if self.orient else (self.e2, self.s2)
+    def __len__(self):
+        return len(self.s1)
 
     def dx(self):
         return (self.e1 - self.s1) % self.L1
@@ -30,63 +25,101 @@ class Segment:
     def dy(self):
         return (self.e2 - self.s2) % self.L2
 
-    def m(self):
-        m = self.dy() / self.dx()
-        return m if self.orient else -m
-
-    def x_runover(self):
-        return (self.s1 > self.e1) and (self.e1 != 0)
-
-    def y_runover(self):
-        return (self.s2 > self.e2) and (self.e2 != 0)
-
-    def split_x(self):
-        assert self.x_runover()
-        Sa, Sb = copy.copy(self), copy.copy(self)
-        Sa.e1 = self.L1
-        Sb.s1 = 0
-        if self.orient:
-            Sa.e2 = Sa.s2 + (Sa.e1 - Sa.s1) * self.m()
-            Sb.s2 = Sb.e2 - (Sb.e1 - Sb.s1) * self.m()
-        else:
-            Sa.s2 = Sa.e2 + (Sa.e1 - Sa.s1) * self.m()
-            Sb.e2 = Sb.s1 - (Sb.e1 - Sb.s1) * self.m()
-
-        return [Sa, Sb]
-
-    def split_y(self):
-        assert self.y_runover()
-        Sa, Sb = copy.copy(self), copy.copy(self)
-        Sa.e2 = self.L2
-        Sb.s2 = 0
-        if self.orient:
-            Sa.e1 = Sa.s1 + (Sa.e2 - Sa.s2) / self.m()
-            Sb.s1 = Sb.e1 - (Sb.e2 - Sb.s2) / self.m()
-        else:
-            Sa.s1 = Sa.e1 + (Sa.e2 - Sa.s2) / self.m()
-            Sb.e1 = Sb.s1 - (Sb.e2 - Sb.s2) / self.m()
-
-        return [Sa, Sb]
-
-
-@dataclass
-class PrivSegment:
-    s: int
-    e: int
-    L: int
-
-    def x(self):
-        return (self.s, self.e)
+    def unwrapped(self):
+        # ends of the segments with the periodic boundary removed: the x
+        # and y coordinates may exceed the genome lengths
+        dx, dy = self.dx(), self.dy()
+        x0, x1 = self.s1, self.s1 + dx
+        y0 = np.where(self.orient, self.s2, self.s2 + dy)
+        y1 = np.where(self.orient, self.s2 + dy, self.s2)
+        return x0, x1, y0, y1
+
+    def split(self):
+        """Cut the segments at the genome boundaries. Each segment is cut
+        at most once on each axis, so it gives one to three pieces. Returns
+        the piece ends (x0, x1, y0, y1) as float arrays, together with the
+        index of the segment that each piece belongs to."""
+        x0, x1, y0, y1 = self.unwrapped()
+        dx, dy = x1 - x0, y1 - y0
+        N = len(self)
+
+        # fraction of the segment at which it crosses each boundary, or 1
+        # if it does not
+        tx = np.ones(N)
+        ty = np.ones(N)
+        cx = x1 > self.L1
+        cy = np.maximum(y0, y1) > self.L2
+        tx[cx] = (self.L1 - x0[cx]) / dx[cx]
+        ty[cy] = (self.L2 - y0[cy]) / dy[cy]
+
+        # break points: 0, the two crossings (sorted) and 1
+        t = np.stack([np.zeros(N), np.minimum(tx, ty), np.maximum(tx, ty)], axis=1)
+        t = np.concatenate([t, np.ones((N, 1))], axis=1)
+        ta, tb = t[:, :-1].ravel(), t[:, 1:].ravel()
+        idx = np.repeat(np.arange(N), 3)
+        # drop the empty pieces of segments with less than two crossings,
+        # but keep the only piece of zero-length segments
+        keep = (tb > ta) | (np.arange(3 * N) % 3 == 0)
+        ta, tb, idx = ta[keep], tb[keep], idx[keep]
+
+        px0 = x0[idx] + ta * dx[idx]
+        px1 = x0[idx] + tb * dx[idx]
+        py0 = y0[idx] + ta * dy[idx]
+        py1 = y0[idx] + tb * dy[idx]
+
+        # move the pieces past a boundary back into the genome
+        ox = np.where((px0 + px1) / 2 > self.L1, self.L1, 0)
+        oy = np.where((py0 + py1) / 2 > self.L2, self.L2, 0)
+        return px0 - ox, px1 - ox, py0 - oy, py1 - oy, idx
+
+
+class PrivSegmentArray:
+    """Many intervals from s[i] to e[i] on a circular genome of length L,
+    stored as arrays."""
+
+    def __init__(self, s, e, L):
+        self.L = L
+        self.s = np.asarray(s, dtype=np.int64) % L
+        self.e = np.asarray(e, dtype=np.int64) % L
+
+    def __len__(self):
+        return len(self.s)
 
     def dx(self):
         return (self.e - self.s) % self.L
 
-    def x_runover(self):
-        return self.s > self.e
-
-    def split_x(self):
-        assert self.x_runover()
-        Sa, Sb = copy.copy(self), copy.copy(self)
-        Sa.e = self.L
-        Sb.s = 0
-        return [Sa, Sb]
+    def split(self):
+        """Cut the intervals at the origin. Returns the piece ends (x0, x1)
+        and the index of the interval that each piece belongs to."""
+        x0, x1 = self.s, self.s + self.dx()
+        ro = np.flatnonzero(x1 > self.L)
+        idx = np.concatenate([np.arange(len(self)), ro])
+        px0 = np.concatenate([x0, np.zeros(len(ro), dtype=np.int64)])
+        px1 = np.concatenate([np.minimum(x1, self.L), x1[ro] - self.L])
+        order = np.argsort(idx, kind="stable")
+        return px0[order], px1[order], idx[order]
+
+
+def line_samples(x0, x1, y0, y1, bx, by):
+    """Points along the pieces returned by `split`, spaced less than half a
+    bin of size bx x by apart, to bin segments on a grid. Returns the point
+    coordinates, the number of bp (along x) that each point stands for and
+    the index of its piece."""
+    n = np.ceil(2 * np.maximum(np.abs(x1 - x0) / bx, np.abs(y1 - y0) / by))
+    n = n.astype(np.int64) + 1
+    idx = np.repeat(np.arange(len(n)), n)
+    # midpoints of n equal sub-pieces
+    k = np.arange(len(idx)) - np.repeat(np.cumsum(n) - n, n)
+    t = (k + 0.5) / n[idx]
+    x = x0[idx] + t * (x1 - x0)[idx]
+    y = y0[idx] + t * (y1 - y0)[idx]
+    w = (np.abs(x1 - x0) / n)[idx]
+    return x, y, w, idx
+
+
+def line_coords(a0, a1):
+    """Interleave the piece ends as a0[0], a1[0], nan, a0[1], a1[1], nan, ...
+    so that a single line trace draws all pieces."""
+    res = np.full((len(a0), 3), np.nan)
+    res[:, 0], res[:, 1] = a0, a1
+    return res.ravel()
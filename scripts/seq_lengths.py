@@ -1,27 +1,135 @@
-from Bio import SeqIO
 import pandas as pd
+import hashlib
+import pathlib
 import argparse
+import gzip
+import os
+
+# columns of a samtools .fai index
+FAI_COLS = ["id", "length", "offset", "linebases", "linewidth"]
 
 
 def parse_args():
     parser = argparse.ArgumentParser()
-    parser.add_argument("--fastas", type=str, nargs="+", help="Fasta files")
+    parser.add_argument(
+        "--fastas", type=str, nargs="+", help="Fasta files, possibly gzipped"
+    )
     parser.add_argument("--output", type=str, help="Output file")
     return parser.parse_args()
 
 
+def is_gzip(fname):
+    with open(fname, "rb") as f:
+        return f.read(2) == b"\x1f\x8b"
+
+
+def is_bgzip(fname):
+    # bgzip files have the "BC" subfield in the gzip extra field
+    with open(fname, "rb") as f:
+        head = f.read(14)
+    return len(head) == 14 and bool(head[3] & 4) and head[12:14] == b"BC"
+
+
+def open_fasta(fname):
+    # binary stream of the (decompressed) file
+    if is_gzip(fname):
+        return gzip.open(fname, "rb")
+    return open(fname, "rb", buffering=1 << 20)
+
+
+def scan_fasta(fasta_file):
+    """Single pass over a fasta file, counting residues line by line without
+    building sequence objects. Returns the .fai records of the contigs and
+    the md5 checksum of the upper-case sequence of each. For gzipped files
+    offsets refer to the decompressed stream."""
+    fai, hashes = [], {}
+    rec, h = None, None
+    offset = 0
+    with open_fasta(fasta_file) as f:
+        for line in f:
+            offset += len(line)
+            if line.startswith(b">"):
+                name = line[1:].split(maxsplit=1)[0].decode()
+                rec = dict(id=name, length=0, offset=offset, linebases=0, linewidth=0)
+                fai.append(rec)
+                h = hashes[name] = hashlib.md5()
+                continue
+            seq = line.rstrip()
+            if rec is None or len(seq) == 0:
+                continue
+            if rec["linebases"] == 0:
+                rec["linebases"], rec["linewidth"] = len(seq), len(line)
+            rec["length"] += len(seq)
+            h.update(seq.upper())
+    return fai, {k: h.hexdigest() for k, h in hashes.items()}
+
+
+def index_files(fasta_file):
+    """The samtools-compatible `.fai` index of the fasta file, and the `.md5`
+    file with the checksum of each contig."""
+    return pathlib.Path(f"{fasta_file}.fai"), pathlib.Path(f"{fasta_file}.md5")
+
+
+def is_fresh(index_file, fasta_file):
+    # the index exists and is not older than the fasta file
+    try:
+        return index_file.stat().st_mtime_ns >= os.stat(fasta_file).st_mtime_ns
+    except FileNotFoundError:
+        return False
+
+
+def read_index(index_file, cols):
+    df = pd.read_csv(index_file, sep="\t", header=None, dtype={0: str})
+    df = df.iloc[:, : len(cols)]
+    df.columns = cols
+    return df
+
+
+def write_index(index_file, df):
+    # atomic, and skipped if the data folder is not writable
+    tmp_file = index_file.with_name(f"{index_file.name}.{os.getpid()}.tmp")
+    try:
+        df.to_csv(tmp_file, sep="\t", header=False, index=False)
+        os.replace(tmp_file, index_file)
+    except OSError:
+        tmp_file.unlink(missing_ok=True)
+
+
+def get_seq_info(fasta_file, checksum=True):
+    """Length of each contig of a (possibly gzipped) fasta file and, if
+    `checksum`, the md5 checksum of its upper-case sequence. These are read
+    from the `.fai` and `.md5` files next to the fasta file when they are
+    up to date. Otherwise they are computed in a single pass over the file
+    and the missing index files are saved for later reuse. An existing
+    `.fai` is never overwritten, and none is written for gzip files that
+    are not bgzip, since samtools cannot use it."""
+    fai_file, md5_file = index_files(fasta_file)
+    fai_fresh = is_fresh(fai_file, fasta_file)
+    md5_fresh = is_fresh(md5_file, fasta_file)
+
+    if fai_fresh and (md5_fresh or not checksum):
+        df = read_index(fai_file, FAI_COLS)[["id", "length"]]
+        if checksum:
+            md5 = read_index(md5_file, ["id", "md5"]).set_index("id")["md5"]
+            df["md5"] = df["id"].map(md5)
+    else:
+        fai, hashes = scan_fasta(fasta_file)
+        df = pd.DataFrame(fai, columns=FAI_COLS)
+        if not (fai_file.exists() or (is_gzip(fasta_file) and not is_bgzip(fasta_file))):
+            write_index(fai_file, df)
+        if not md5_fresh:
+            md5 = pd.DataFrame({"id": list(hashes), "md5": list(hashes.values())})
+            write_index(md5_file, md5)
+        df = df[["id", "length"]]
+        if checksum:
+            df["md5"] = df["id"].map(hashes)
+
+    df.insert(2, "file", fasta_file)
+    return df.to_dict("records")
+
+
 def get_seq_lengths(fasta_file):
-    seq_lengths = []
-    for record in SeqIO.parse(fasta_file, "fasta"):
-        L = len(record.seq)
-        seq_lengths.append(
-            {
-                "id": record.id,
-                "length": L,
-                "file": fasta_file,
-            }
-        )
-    return seq_lengths
+    return get_seq_info(fasta_file, checksum=False)
 
 
 if __name__ == "__main__":
@@ -29,7 +137,7 @@ if __name__ == "__main__":
 
     seq_lengths = []
     for fasta_file in args.fastas:
-        seq_lengths.extend(get_seq_lengths(fasta_file))
+        seq_lengths.extend(get_seq_info(fasta_file))
     df = pd.DataFrame(seq_lengths)
 
     df.to_csv(args.output, index=False)
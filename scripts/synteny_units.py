@@ -1,6 +1,6 @@
 # %%
 
-import pypangraph as pp
+import graph_cache as gc
 import glue_utils as gu
 import argparse
 
@@ -9,36 +9,54 @@ def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument("--graph", type=str, required=True)
     parser.add_argument("--out", type=str, required=True)
+    parser.add_argument(
+        "--genomes",
+        type=str,
+        nargs="+",
+        help="Genomes whose paths must agree to extend MSUs (default: all). "
+        "The table still covers all genomes.",
+    )
     return parser.parse_args()
 
 
-if __name__ == "__main__":
-
-    args = parse_args()
-
-    pan = pp.Pangraph.load_json(args.graph)
-    bdf = pan.to_blockstats_df()
-
-    paths = gu.pan_to_paths(pan)
-    k1, k2 = list(paths.keys())
+def minimal_synteny_units(pan, genomes=None):
+    """MSUs of the paths of `genomes` (by default all paths of the graph).
+    Anchors are blocks present exactly once in each of these genomes, and
+    are extended through neighbouring blocks as long as the flanking edges
+    agree in all of them. The MSUs are then projected on the paths of the
+    other genomes, so that the table covers every path of the graph."""
+    all_paths = gu.pan_to_paths(pan)
+    if genomes is None:
+        genomes = list(all_paths)
+    missing = set(genomes) - set(all_paths)
+    if missing:
+        raise ValueError(f"genomes {sorted(missing)} not found in the graph")
+    paths = {k: all_paths[k] for k in genomes}
+    k1 = list(paths.keys())[0]
 
     glue = gu.Glue(paths)
 
-    core_blocks = set(bdf[bdf["core"]].index)
+    core_blocks = gu.core_blocks(paths)
 
-    core_nodes = {cb: {} for cb in core_blocks}
-    for k, p in paths.items():
-        for n in p.nodes:
-            if n.bid in core_blocks:
-                core_nodes[n.bid][k] = n
+    # index of the core block occurrences in each path
+    core_idx = {k: p.index(core_blocks) for k, p in paths.items()}
 
+    # anchors in order along the first path, for a deterministic result
     msu_id = 1
-    for cb, cns in core_nodes.items():
-        n1 = cns[k1]
-        n2 = cns[k2]
-        glue.extend(n1, n2, msu_id)
+    for cb in sorted(core_blocks, key=core_idx[k1].get):
+        glue.extend([core_idx[k][cb] for k in paths], msu_id)
         msu_id += 1
 
-    df = glue.to_df()
+    others = [p for k, p in all_paths.items() if k not in paths]
+    for p in others:
+        glue.project(p)
+    return glue.to_df(list(all_paths.values()))
+
+
+if __name__ == "__main__":
+
+    args = parse_args()
+
+    pan = gc.load_graph(args.graph, blocks=())
+    df = minimal_synteny_units(pan, args.genomes)
     df.to_csv(args.out, index=False)
-# %%
@@ -0,0 +1,93 @@
+import numpy as np
+import pandas as pd
+import pathlib
+
+FORMATS = {"csv": ".csv", "parquet": ".parquet"}
+
+# target number of rows per parquet row group. Row groups are cut at changes
+# of block, so that readers can skip blocks using the row-group statistics
+ROW_GROUP_SIZE = 1 << 17
+
+
+def table_format(fname):
+    """Format of a table file, from the magic bytes or (for files that do
+    not exist yet) from the extension."""
+    fname = pathlib.Path(fname)
+    if fname.exists():
+        with open(fname, "rb") as f:
+            return "parquet" if f.read(4) == b"PAR1" else "csv"
+    return "parquet" if fname.suffix == ".parquet" else "csv"
+
+
+def find_table(fld, name):
+    """Path of the table `name` in folder `fld`, in whichever format exists.
+    If both exist (e.g. after changing `table_format`) the newest is used."""
+    fnames = [pathlib.Path(fld) / f"{name}{ext}" for ext in FORMATS.values()]
+    fnames = [f for f in fnames if f.exists()]
+    if len(fnames) == 0:
+        raise FileNotFoundError(f"no table {name} in {fld}")
+    return max(fnames, key=lambda f: f.stat().st_mtime_ns)
+
+
+def to_categorical(df, exclude=()):
+    # dictionary-encode string columns (ids, genome names, mutation types)
+    df = df.copy()
+    for c in df.columns:
+        if df[c].dtype == object and c not in exclude:
+            df[c] = df[c].astype("category")
+    return df
+
+
+def write_parquet(df, fname, index, partition_by):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    table = pa.Table.from_pandas(df, preserve_index=index)
+
+    # row group boundaries, aligned with changes of the partition column.
+    # Rows keep their order, so groups are whole only if rows are sorted
+    if partition_by is None or len(df) == 0:
+        bounds = list(range(0, len(df), ROW_GROUP_SIZE)) + [len(df)]
+    else:
+        key = df[partition_by].astype(str).to_numpy()
+        changes = np.flatnonzero(key[1:] != key[:-1]) + 1
+        bounds = [0]
+        for c in changes:
+            if c - bounds[-1] >= ROW_GROUP_SIZE:
+                bounds.append(c)
+        bounds.append(len(df))
+
+    with pq.ParquetWriter(fname, table.schema) as writer:
+        for s, e in zip(bounds[:-1], bounds[1:]):
+            writer.write_table(table.slice(s, e - s))
+
+
+def write_table(df, fname, index=False, partition_by=None):
+    """Write a table in the format given by the file extension. Parquet
+    tables have dictionary-encoded string columns and row groups that
+    contain whole runs of equal `partition_by` values (e.g. blocks). Rows
+    are written in the same order as in the csv table."""
+    if pathlib.Path(fname).suffix != ".parquet":
+        df.to_csv(fname, index=index)
+    else:
+        df = to_categorical(df, exclude=["seq"])
+        write_parquet(df, fname, index, partition_by)
+
+
+def read_table(fname, columns=None, blocks=None, block_col="block_id"):
+    """Read a csv or parquet table, detecting the format. For parquet only
+    the requested `columns` and the row groups of the requested `blocks`
+    are read. Categorical columns are returned as plain strings, so that
+    the result does not depend on the format."""
+    if table_format(fname) == "csv":
+        df = pd.read_csv(fname, usecols=columns)
+        if blocks is not None:
+            df = df[df[block_col].isin(blocks)]
+        return df
+
+    filters = None if blocks is None else [(block_col, "in", list(blocks))]
+    df = pd.read_parquet(fname, columns=columns, filters=filters)
+    for c in df.columns:
+        if isinstance(df[c].dtype, pd.CategoricalDtype):
+            df[c] = df[c].astype(object)
+    return df